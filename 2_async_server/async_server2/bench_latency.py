@@ -0,0 +1,107 @@
+"""
+Compares the round-trip latency of command_server over TCP loopback vs a unix socket.
+
+Both listeners are served by the same Reactor (running on a background thread), and the
+client sends one line at a time, waiting for the echo before sending the next one.
+
+Usage:
+$ python -m async_server2.bench_latency
+$ python -m async_server2.bench_latency --round-trips 20000
+"""
+import argparse
+import os
+import socket
+import statistics
+import tempfile
+import threading
+import time
+
+from .log import Level, Logger
+from .main import command_server
+from .server import Reactor, create_async_client_socket
+
+END_OF_MESSAGE = b"\r\n\r\n"
+
+
+def read_message(client_socket: socket.socket, buffer: bytearray) -> bytes:
+    """Blocking read of everything up to (and including) the next END_OF_MESSAGE"""
+    while True:
+        end = buffer.find(END_OF_MESSAGE)
+        if end != -1:
+            message = bytes(buffer[:end + len(END_OF_MESSAGE)])
+            del buffer[:end + len(END_OF_MESSAGE)]
+            return message
+
+        data = client_socket.recv(65536)
+        if not data:
+            raise ConnectionError("server closed the connection")
+        buffer += data
+
+
+def measure(address, round_trips: int) -> list[float]:
+    client_socket = create_async_client_socket(address)
+    client_socket.setblocking(True)
+    if client_socket.family != socket.AF_UNIX:
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    buffer = bytearray()
+    # the welcome message comes in 2 parts, the 2nd one ends with END_OF_MESSAGE
+    read_message(client_socket, buffer)
+
+    latencies = []
+    try:
+        for _ in range(round_trips):
+            started = time.perf_counter()
+            client_socket.sendall(b"ping\r\n")
+            read_message(client_socket, buffer)
+            latencies.append(time.perf_counter() - started)
+
+        client_socket.sendall(b"quit\r\n")
+        # wait for the "bye!", otherwise the server would be writing to a closed socket
+        while client_socket.recv(65536):
+            pass
+    finally:
+        client_socket.close()
+    return latencies
+
+
+def report(name: str, latencies: list[float]):
+    latencies = sorted(latencies)
+    p99 = latencies[int(len(latencies) * 0.99)]
+    print(
+        f"{name:>14}: {len(latencies)} round trips, "
+        f"mean {statistics.mean(latencies) * 1e6:8.1f}us, "
+        f"median {statistics.median(latencies) * 1e6:8.1f}us, "
+        f"p99 {p99 * 1e6:8.1f}us"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--round-trips', type=int, default=5000)
+    parser.add_argument('--port', type=int, default=1849)
+    args = parser.parse_args()
+
+    unix_path = os.path.join(tempfile.mkdtemp(), 'command_server.sock')
+
+    reactor = Reactor.get_instance()
+    reactor.add_server_socket_and_callback(('localhost', args.port, True), command_server)
+    reactor.add_server_socket_and_callback(unix_path, command_server)
+
+    results = {}
+    # keep command_server's 'connected'/'line_received'/'quit' records out of the report
+    Logger.get_instance().level = Level.warning
+    threading.Thread(target=reactor.start_reactor, daemon=True).start()
+
+    for name, address in (('tcp loopback', ('localhost', args.port)), ('unix socket', unix_path)):
+        # warm up, then measure
+        measure(address, min(500, args.round_trips))
+        results[name] = measure(address, args.round_trips)
+
+    for name, latencies in results.items():
+        report(name, latencies)
+    os.unlink(unix_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Throughput of the proxy (proxy.py): MB/s, and MB/s per core (per second of CPU the proxy used).
+
+The proxy runs in its own process, between a client and an echo server in this process.
+The client pushes `--megabytes` through it and reads them back, so the proxy relays
+twice that in total. The proxy process's CPU time comes from its rusage once it exits.
+
+Usage:
+$ python -m async_server2.bench_proxy
+$ python -m async_server2.bench_proxy --megabytes 2000 --no-splice
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import signal
+import socket
+import threading
+import time
+
+from .proxy import CAN_SPLICE, DEFAULT_BUFFER_SIZE, relay_to
+from .server import Reactor
+
+CHUNK = 1024 * 1024
+
+
+def echo_server(server_socket: socket.socket):
+    while True:
+        connection, _ = server_socket.accept()
+        threading.Thread(target=echo, args=(connection,), daemon=True).start()
+
+
+def echo(connection: socket.socket):
+    buffer = memoryview(bytearray(CHUNK))
+    with connection:
+        while True:
+            received = connection.recv_into(buffer)
+            if not received:
+                connection.shutdown(socket.SHUT_WR)
+                return
+            connection.sendall(buffer[:received])
+
+
+def run_proxy(listen_port, upstream_port, use_splice, buffer_size):
+    # the parent stops us with SIGTERM. Exit cleanly, so the rusage gets reported
+    signal.signal(signal.SIGTERM, lambda *_: os._exit(0))
+    reactor = Reactor.get_instance()
+    reactor.add_server_socket_and_callback(
+        ('127.0.0.1', listen_port, True), relay_to('127.0.0.1', upstream_port, use_splice, buffer_size)
+    )
+    reactor.start_reactor()
+
+
+def push_through(port: int, total_bytes: int) -> float:
+    """Send total_bytes through the proxy and read them back. Returns the elapsed seconds"""
+    client = socket.create_connection(('127.0.0.1', port))
+    payload = b'x' * CHUNK
+    received = 0
+
+    def send_all():
+        sent = 0
+        while sent < total_bytes:
+            client.sendall(payload)
+            sent += len(payload)
+        client.shutdown(socket.SHUT_WR)
+
+    started = time.perf_counter()
+    sender = threading.Thread(target=send_all)
+    sender.start()
+    buffer = bytearray(CHUNK)
+    while True:
+        count = client.recv_into(buffer)
+        if not count:
+            break
+        received += count
+    elapsed = time.perf_counter() - started
+    sender.join()
+    client.close()
+
+    assert received == total_bytes, f"sent {total_bytes}, got {received} back"
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--megabytes', type=int, default=500)
+    parser.add_argument('--no-splice', action='store_true')
+    parser.add_argument('--buffer-size', type=int, default=DEFAULT_BUFFER_SIZE)
+    parser.add_argument('--port', type=int, default=1850)
+    args = parser.parse_args()
+    use_splice = CAN_SPLICE and not args.no_splice
+
+    upstream = socket.create_server(('127.0.0.1', 0))
+    threading.Thread(target=echo_server, args=(upstream,), daemon=True).start()
+
+    proxy = multiprocessing.get_context('fork').Process(
+        target=run_proxy, args=(args.port, upstream.getsockname()[1], use_splice, args.buffer_size)
+    )
+    proxy.start()
+    time.sleep(0.5)
+
+    total_bytes = (args.megabytes * 1024 * 1024) // CHUNK * CHUNK
+    try:
+        elapsed = push_through(args.port, total_bytes)
+    finally:
+        proxy.terminate()
+        proxy.join()
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_seconds = usage.ru_utime + usage.ru_stime
+    # both directions went through the proxy
+    relayed_mb = 2 * total_bytes / 1024 / 1024
+    print(
+        f"{'splice' if use_splice else 'recv_into'}: relayed {relayed_mb:.0f}MB in {elapsed:.2f}s, "
+        f"{relayed_mb / elapsed:.0f} MB/s, proxy used {cpu_seconds:.2f}s of CPU: "
+        f"{relayed_mb / cpu_seconds:.0f} MB/s per core"
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+WebSocket throughput: messages/sec, for small and large messages.
+
+- parser: FrameParser.feed() on masked frames, in memory. That's the framing + unmasking cost alone
+- echo: end to end. The Reactor (on a background thread) runs an echo handler behind upgrade(),
+  and a client keeps a window of messages in flight, so the server is never waiting on it
+
+Also compares apply_mask() with the per-byte loop it replaces.
+
+Usage:
+$ python -m async_server2.bench_websocket
+$ python -m async_server2.bench_websocket --messages 50000
+"""
+import argparse
+import base64
+import os
+import socket
+import threading
+import time
+
+from .io import readline
+from .log import Level, Logger
+from .server import Reactor, Session
+from .websocket import FrameParser, Opcode, apply_mask, pack_frame, upgrade
+
+SIZES = {'small': 32, 'large': 64 * 1024}
+
+
+async def echo_lines(s: Session):
+    while True:
+        line = await readline()
+        if not line:
+            return
+        s.write(line.encode())
+
+
+def per_byte_mask(payload: bytes, mask: bytes) -> bytes:
+    return bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+
+
+class Client:
+    """Minimal blocking websocket client"""
+
+    def __init__(self, address):
+        self.socket = socket.create_connection(address)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.parser = FrameParser(require_mask=False)
+        key = base64.b64encode(os.urandom(16))
+        self.socket.sendall(
+            b"GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            b"Sec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\n\r\n" % key
+        )
+        response = b''
+        while b"\r\n\r\n" not in response:
+            data = self.socket.recv(4096)
+            if not data:
+                raise ConnectionError("server closed the connection during the handshake")
+            response += data
+        head, _, leftover = response.partition(b"\r\n\r\n")
+        if not head.startswith(b"HTTP/1.1 101"):
+            raise ConnectionError(f"handshake failed: {head!r}")
+        # frames the server sent right behind the handshake's response
+        self.pending = self.parser.feed(leftover)
+
+    def send(self, opcode: int, payload: bytes):
+        self.socket.sendall(pack_frame(opcode, payload, mask=os.urandom(4)))
+
+    def receive(self) -> list:
+        while not self.pending:
+            data = self.socket.recv(256 * 1024)
+            if not data:
+                raise ConnectionError("server closed the connection")
+            self.pending = self.parser.feed(data)
+        frames, self.pending = self.pending, []
+        return frames
+
+    def close(self):
+        self.socket.close()
+
+
+def bench_parser(size: int, messages: int) -> float:
+    frame = pack_frame(Opcode.text, b'x' * size, mask=os.urandom(4))
+    # about what a recv() hands over at once
+    chunk_messages = max(1, 64 * 1024 // len(frame))
+    chunk = frame * chunk_messages
+    parser = FrameParser()
+
+    started = time.perf_counter()
+    parsed = 0
+    while parsed < messages:
+        parsed += len(parser.feed(chunk))
+    return parsed / (time.perf_counter() - started)
+
+
+def bench_echo(address, size: int, messages: int, window: int) -> float:
+    client = Client(address)
+    payload = b'x' * (size - 1) + b'\n'
+    # the server's writes don't wait for the socket to drain: don't let too much pile up
+    in_flight = threading.Semaphore(window)
+
+    def send_all():
+        for _ in range(messages):
+            in_flight.acquire()
+            client.send(Opcode.text, payload)
+
+    started = time.perf_counter()
+    sender = threading.Thread(target=send_all)
+    sender.start()
+    received = 0
+    while received < messages:
+        for frame in client.receive():
+            assert len(frame.payload) == size, f"expected {size} bytes, got {len(frame.payload)}"
+            received += 1
+            in_flight.release()
+    elapsed = time.perf_counter() - started
+    sender.join()
+    client.close()
+    return messages / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--port', type=int, default=1852)
+    args = parser.parse_args()
+
+    Logger.get_instance().level = Level.warning
+    reactor = Reactor.get_instance()
+    reactor.add_server_socket_and_callback(('127.0.0.1', args.port, True), upgrade(echo_lines, ping_interval=None))
+    threading.Thread(target=reactor.start_reactor, daemon=True).start()
+    address = ('127.0.0.1', args.port)
+
+    for name, size in SIZES.items():
+        # big messages take longer, don't take all day
+        messages = args.messages if size < 1024 else args.messages // 10
+        parsed = bench_parser(size, messages)
+        echoed = bench_echo(address, size, messages, window=64 if size < 1024 else 8)
+        print(
+            f"{name:>6} ({size} bytes): parser {parsed:10.0f} messages/s ({parsed * size / 1e6:7.1f} MB/s), "
+            f"echo {echoed:8.0f} messages/s ({echoed * size / 1e6:6.1f} MB/s)"
+        )
+
+    payload, mask = os.urandom(SIZES['large']), os.urandom(4)
+    assert apply_mask(payload, mask) == per_byte_mask(payload, mask)
+    timings = {}
+    for name, function, repeat in (('apply_mask', apply_mask, 200), ('per byte loop', per_byte_mask, 5)):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            function(payload, mask)
+        timings[name] = (time.perf_counter() - started) / repeat
+    print(
+        f"unmasking {len(payload)} bytes: apply_mask {timings['apply_mask'] * 1e6:.1f}us, "
+        f"per byte loop {timings['per byte loop'] * 1e6:.1f}us "
+        f"({timings['per byte loop'] / timings['apply_mask']:.0f}x slower)"
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Streaming compression for a Session's output and/or input, for clients on slow links.
+
+It's a Layer (see server.Session.layers), so the handler doesn't know about it. Once it's on,
+everything the session writes goes through a single deflate stream, until the session ends:
+
+- every write is a message, and ends with a sync flush (Z_SYNC_FLUSH). So the client can
+  decompress everything it received so far, without waiting for more
+- the compressor's window carries over from one message to the next, so repetitive output
+  (the help text, similar http responses...) compresses much better than each message would
+  on its own
+
+The stream is raw deflate (no zlib header or checksum), like in permessage-deflate. That also
+means the level can be changed in the middle: after a sync flush, a new compressor's output
+is just more deflate blocks of the same stream.
+
+Input works the same in reverse: the client sends a raw deflate stream, and flushes it whenever
+it wants us to see what it wrote so far.
+
+From command_server:
+    compress [level]   - compress the output, from right after the reply on. Again to change the level
+    decompress         - the input is compressed, from the next byte on
+
+A client, in python:
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    ...
+    text = decompressor.decompress(sock.recv(65536))
+"""
+import time
+import zlib
+from typing import Optional
+
+from .log import Logger
+from .server import Layer, Session
+
+DEFAULT_LEVEL = 6
+
+# Refuse to inflate a single read into more than this (a few KB can inflate to many MB)
+MAX_DECOMPRESSED = 16 * 1024 * 1024
+
+logger = Logger.get_instance()
+
+
+def check_level(level: int):
+    if not zlib.Z_NO_COMPRESSION <= level <= zlib.Z_BEST_COMPRESSION:
+        raise ValueError(f"compression level should be 0 to 9, not {level}")
+
+
+class CompressionLayer(Layer):
+    def __init__(self, session: Session):
+        self.session = session
+        self.level = None  # type: Optional[int]
+        self._compressor = None
+        self._decompressor = None
+
+        # bytes the handler wrote, and what went out for them. Same for the input
+        self.output_raw = 0
+        self.output_compressed = 0
+        self.input_compressed = 0
+        self.input_raw = 0
+        # CPU seconds spent (de)compressing
+        self.cpu_time = 0.0
+
+    def compress_output(self, level: int = DEFAULT_LEVEL):
+        check_level(level)
+        # if there was a compressor already, nothing's left in it: every message ends with a sync flush
+        self.level = level
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    @property
+    def compressing(self) -> bool:
+        return self._compressor is not None
+
+    @property
+    def decompressing(self) -> bool:
+        return self._decompressor is not None
+
+    def decompress_input(self):
+        if not self._decompressor:
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def encode(self, data: bytes) -> bytes:
+        if self._compressor is None or not data:
+            return data
+        started = time.thread_time()
+        compressed = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.cpu_time += time.thread_time() - started
+        self.output_raw += len(data)
+        self.output_compressed += len(compressed)
+        return compressed
+
+    def decode(self, data: bytes) -> bytes:
+        if self._decompressor is None:
+            return data
+        started = time.thread_time()
+        try:
+            decompressed = self._decompressor.decompress(data, MAX_DECOMPRESSED)
+        except zlib.error as err:
+            logger.warning('decompression_failed', "%s", err, address=self.session.address)
+            raise ConnectionAbortedError(f"can't decompress the input: {err}") from err
+        finally:
+            self.cpu_time += time.thread_time() - started
+        if self._decompressor.unconsumed_tail:
+            logger.warning('decompression_bomb', address=self.session.address, limit=MAX_DECOMPRESSED)
+            raise ConnectionAbortedError(f"input inflates to more than {MAX_DECOMPRESSED} bytes")
+
+        self.input_compressed += len(data)
+        self.input_raw += len(decompressed)
+        return decompressed
+
+    def report(self) -> str:
+        lines = [f"Compression for {self.session.address}: {self.cpu_time * 1000:.3f}ms of CPU"]
+        if self.compressing:
+            lines.append(
+                f"  output (level {self.level}): {self.output_raw} -> {self.output_compressed} bytes "
+                f"({_ratio(self.output_raw, self.output_compressed)})"
+            )
+        if self.decompressing:
+            lines.append(
+                f"  input: {self.input_compressed} -> {self.input_raw} bytes "
+                f"({_ratio(self.input_raw, self.input_compressed)})"
+            )
+        return "\n".join(lines)
+
+
+def _ratio(raw: int, compressed: int) -> str:
+    return f"ratio {raw / compressed:.2f}" if compressed else "nothing yet"
+
+
+def get_layer(s: Session) -> Optional[CompressionLayer]:
+    for layer in s.layers:
+        if isinstance(layer, CompressionLayer):
+            return layer
+    return None
+
+
+def _get_or_add_layer(s: Session) -> CompressionLayer:
+    layer = get_layer(s)
+    if layer is None:
+        layer = CompressionLayer(s)
+        # innermost: it sees what the handler wrote, before any framing (e.g. websocket)
+        s.add_layer(layer)
+    return layer
+
+
+def compress_output(s: Session, level: int = DEFAULT_LEVEL) -> CompressionLayer:
+    """Compress everything `s` writes from now on"""
+    layer = _get_or_add_layer(s)
+    layer.compress_output(level)
+    return layer
+
+
+def decompress_input(s: Session) -> CompressionLayer:
+    """Decompress everything `s` receives from now on
+
+    Including what was received already, but not read yet by the handler.
+    Raises ConnectionAbortedError if that's not a valid deflate stream
+    """
+    layer = _get_or_add_layer(s)
+    if layer.decompressing:
+        return layer
+    layer.decompress_input()
+    s.decode_buffered(layer)
+    return layer
@@ -0,0 +1,128 @@
+"""
+Binary, length-prefixed framing for command_server.
+
+The telnet-style protocol decodes, strips, splits and re-encodes every line, and it can't carry
+binary payloads. Programmatic clients can switch a connection to this binary mode instead:
+
+1. The client connects, and sends PREAMBLE (it's also a valid line, so it goes through readline)
+2. The server answers with PREAMBLE. Everything the server sent before it (the welcome
+   message) should be discarded by the client
+3. Only after receiving the PREAMBLE back, the client starts sending frames
+
+Every frame (in both directions) is a HEADER followed by `length` bytes of payload:
+
+    opcode: u8 | request_id: u32 | length: u32   (network byte order)
+
+Requests don't need to wait for each other. A response has the request's opcode with the
+RESPONSE bit set and the same request_id, and responses can come back in any order
+(a slow `http` request doesn't hold back the `upper` ones sent after it).
+"""
+import enum
+import socket
+import struct
+from typing import NamedTuple
+
+PREAMBLE = b"\x00CMDBIN1\r\n"
+
+HEADER = struct.Struct('!BII')
+
+# Refuse to buffer more than this for a single frame
+MAX_PAYLOAD = 16 * 1024 * 1024
+
+RESPONSE = 0x80
+
+
+class Opcode(enum.IntEnum):
+    upper = 1
+    lower = 2
+    title = 3
+    http = 4  # payload: b"<host> [<port>] [timeout=<seconds>]"
+    quit = 5
+    error = 0x7F  # payload: error message. Sent with the request_id of the failed request
+
+
+class Frame(NamedTuple):
+    opcode: int
+    request_id: int
+    payload: bytes
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def pack_frame(opcode: int, request_id: int, payload: bytes = b'') -> bytes:
+    return HEADER.pack(opcode, request_id, len(payload)) + payload
+
+
+class FrameReader:
+    """Incremental parser: feed it whatever recv() returned, get back the complete frames"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> list[Frame]:
+        self._buffer += data
+        frames = []
+        offset = 0
+        header_size = HEADER.size
+
+        # Parse in place, and only cut the consumed prefix off once at the end
+        while len(self._buffer) - offset >= header_size:
+            opcode, request_id, length = HEADER.unpack_from(self._buffer, offset)
+            if length > MAX_PAYLOAD:
+                raise ProtocolError(f"frame of {length} bytes is too large")
+
+            end = offset + header_size + length
+            if end > len(self._buffer):
+                break
+            frames.append(Frame(opcode, request_id, bytes(self._buffer[offset + header_size:end])))
+            offset = end
+
+        if offset:
+            del self._buffer[:offset]
+        return frames
+
+
+class BinaryClient:
+    """Minimal blocking client, for scripts and benchmarks"""
+
+    def __init__(self, address):
+        self.socket = socket.create_connection(address)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._reader = FrameReader()
+        self._next_request_id = 0
+        self._negotiate()
+
+    def _negotiate(self):
+        self.socket.sendall(PREAMBLE)
+        received = b''
+        while PREAMBLE not in received:
+            data = self.socket.recv(4096)
+            if not data:
+                raise ProtocolError("server closed the connection during negotiation")
+            received += data
+
+        # the server doesn't send frames until we do, but just in case
+        leftover = received[received.index(PREAMBLE) + len(PREAMBLE):]
+        if leftover:
+            raise ProtocolError(f"unexpected data after the preamble: {leftover!r}")
+
+    def send(self, opcode: Opcode, payload: bytes = b'') -> int:
+        """Send a request without waiting for the response. Returns the request id"""
+        self._next_request_id += 1
+        self.socket.sendall(pack_frame(opcode, self._next_request_id, payload))
+        return self._next_request_id
+
+    def receive(self) -> list[Frame]:
+        """Block until at least one frame arrives, and return the frames received"""
+        while True:
+            data = self.socket.recv(65536)
+            if not data:
+                raise ProtocolError("server closed the connection")
+            frames = self._reader.feed(data)
+            if frames:
+                return frames
+
+    def close(self):
+        self.socket.close()
@@ -1,70 +1,278 @@
+import errno
+import os
+import socket
+import time
 import types
-from .server import Session, Reactor, create_async_client_socket, IOIntention
+from typing import Callable, Any, Optional
+from .resolver import Address, Resolver
+from .server import Session, Reactor, IOIntention
+
+
+def _fill_read_buffer(session: Session) -> Optional[bool]:
+    """Read at most one read budget worth of bytes into session.read_buffer
+
+    Returns False on EOF, None if there was nothing to read after all, True otherwise
+    """
+    reactor = Reactor.get_instance()
+    try:
+        data = session.socket.recv(reactor.read_budget)
+    except BlockingIOError:
+        return None
+    except ConnectionError:
+        return False
+    if not data:
+        return False
+
+    reactor.charge_read(session, 0, len(data))
+    try:
+        for layer in session.layers:
+            data = layer.decode(data)
+    except ConnectionError:
+        # a layer got something it can't decode. Same as if the client hung up
+        return False
+    session.read_buffer += data
+    return True
 
 
 # TODO - why does this have to be a @types.coroutine again?
 @types.coroutine
 def readline():
-    """A non-blocking readline to use with two-way generators"""
+    """A non-blocking readline to use with two-way generators
+
+    Returns a str line, including the line ending. '' means the client went away
+    """
 
     # TODO - preferably replace generators with async functions
     def inner(session: Session):
-        # socket_.makefile().readline() works just as well!
-        result = session.file.readline()
+        # socket_.makefile().readline() works just as well! ...except that it reads ahead,
+        # and the lines it buffered are invisible to select(), so they got stuck there
+        buffer = session.read_buffer
+        end = buffer.find(b'\n')
+        if end == -1:
+            received = _fill_read_buffer(session)
+            if received is None:
+                return
+            end = buffer.find(b'\n')
+            if end == -1:
+                if received:
+                    # partial line. Wait for the rest
+                    return
+                end = len(buffer) - 1
 
-        Reactor.get_instance().make_progress(session, result, IOIntention.none)
+        line = bytes(buffer[:end + 1])
+        del buffer[:end + 1]
+        session.input_pending = b'\n' in buffer
+
+        reactor = Reactor.get_instance()
+        reactor.make_progress(session, line.decode('utf-8', 'replace'), IOIntention.none)
+        reactor.charge_read(session, 1, 0)
 
+    inner.reads_buffer = True
     line = yield inner
     return line
 
 
 @types.coroutine
-def simple_http_get(url, port=80, headers=None):
-    """Simple interface to make an HTTP GET request
+def recv_some():
+    """A non-blocking socket.recv(): whatever bytes are available. b'' means the peer closed
 
-     Return the entire request (line,headers,body) as raw bytes
-     """
-    client_socket = create_async_client_socket((url, port))
+    Anything readline() buffered but didn't return comes first
+    """
 
-    calling_session = Reactor.get_instance().get_current_session()
-
-    @types.coroutine
-    def send_request(request_bytes):
-        def send_request_inner(session: Session):
-            try:
-                # TODO - maybe we can't send the entire request at once.
-                #  there might be a reason why both .send and .sendall exist
-                result = session.socket.sendall(request_bytes)
-            except BrokenPipeError as err:
-                session.close()
+    def inner(session: Session):
+        if not session.read_buffer:
+            received = _fill_read_buffer(session)
+            if received is None or (received and not session.read_buffer):
+                # spurious wakeup, or a layer is still waiting for the rest of something.
+                # Try again the next time the socket is ready
                 return
 
-            # The result is None...whatever!
-            Reactor.get_instance().make_progress(session, result, IOIntention.read)
-        none = yield send_request_inner
-        return none
-
-    @types.coroutine
-    def receive_response(none):
-        def receive_response_inner(session: Session):
-            # TODO - so... can we just "read a line"?
-            #  isn't the line MAYBE chunked, and we have to yield control,
-            #  and wait for the socket to be readable again?
-
-            # Weird stuff happening here!
-            # Some sites send me a '\n' first
-            # Well I guess I should skip that
+        result = bytes(session.read_buffer)
+        session.read_buffer.clear()
+        session.input_pending = False
+        Reactor.get_instance().make_progress(session, result, IOIntention.none)
+
+    inner.reads_buffer = True
+    data = yield inner
+    return data
+
+
+@types.coroutine
+def _send_request(request_bytes):
+    def send_request_inner(session: Session):
+        try:
+            # TODO - maybe we can't send the entire request at once.
+            #  there might be a reason why both .send and .sendall exist
+            result = session.socket.sendall(request_bytes)
+        except OSError as err:
+            # reset, broken pipe... The request gets the error instead of a response
+            Reactor.get_instance().make_progress(session, err, IOIntention.none)
+            return
+
+        # make_progress doesn't look at its `next_intention`, so switch over ourselves.
+        # Otherwise we'd keep getting called because the socket is writable, and spin
+        session.io_intention = IOIntention.read
+        # The result is None...whatever!
+        Reactor.get_instance().make_progress(session, result, IOIntention.read)
+    none = yield send_request_inner
+    return none
+
+
+@types.coroutine
+def _receive_response(none):
+    received = []
+
+    def receive_response_inner(session: Session):
+        # The socket is non-blocking, so we might get a partial line, or nothing at all.
+        # In that case, we just wait until the socket is readable again (instead of spinning
+        # here, and blocking every other session)
+
+        # Weird stuff happening here!
+        # Some sites send me a '\n' first
+        # Well I guess I should skip that
+        try:
             result_part = session.file.readline()
-            result_buffer = result_part
+        except BlockingIOError:
+            return
+        except OSError as err:
+            # e.g. the server reset the connection. Hand it over, instead of crashing the reactor
+            Reactor.get_instance().make_progress(session, err, IOIntention.none)
+            return
+        if result_part and not received and not result_part.strip():
+            return
+        received.append(result_part)
+        if result_part and not result_part.endswith('\n'):
+            return
+        # (readline() only returns '' here, when the socket was readable, on EOF)
+
+        Reactor.get_instance().make_progress(session, ''.join(received), IOIntention.none)
+    res = yield receive_response_inner
+    return res
+
+
+def _interleave_families(addresses: list[Address]) -> list[Address]:
+    """Happy eyeballs (RFC 8305) ordering: alternate address families, keeping the
+    resolver's preference for which family goes first"""
+    by_family = {}  # type: dict[int, list[Address]]
+    for address in addresses:
+        by_family.setdefault(address.family, []).append(address)
+
+    interleaved = []
+    queues = list(by_family.values())
+    while queues:
+        for queue in queues:
+            interleaved.append(queue.pop(0))
+        queues = [queue for queue in queues if queue]
+    return interleaved
+
+
+def connect_happy_eyeballs(
+        addresses: list[Address],
+        async_callback,
+        on_error: Callable[[OSError], Any],
+        attempt_delay: float = 0.25,
+        timeout: float = 10.0,
+):
+    """Connect to the first address that answers, and run `async_callback` on it in a new session
+
+    Connection attempts start `attempt_delay` apart (or right away, when the previous one
+    failed), alternating between IPv6 and IPv4, and the first one to connect wins. That way a
+    broken IPv6 route (or a dead server behind one of the addresses) costs a quarter of a second,
+    instead of a whole connect timeout.
+
+    Returns a function which cancels the whole thing: the attempts still connecting,
+    or the winner's session if there's one already.
+    """
+    reactor = Reactor.get_instance()
+    pending = _interleave_families(addresses)
+    attempts = []  # type: list[Session]
+    state = {'done': False, 'last_error': None}
+
+    def finish_with_error(err: OSError):
+        if state['done']:
+            return
+        state['done'] = True
+        for attempt_session in attempts:
+            reactor.close_session(attempt_session)
+        on_error(err)
+
+    def attempt_failed(err: OSError):
+        state['last_error'] = err
+        if pending:
+            start_next_attempt()
+        elif not attempts:
+            # that was the last one still trying
+            finish_with_error(err)
+
+    async def attempt_callback(s: Session):
+        # Sessions for client sockets start when the socket becomes writable,
+        # which is when the connection either succeeded, or failed
+        error = s.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if state['done']:
+            return
+        if error:
+            attempts.remove(s)
+            attempt_failed(ConnectionError(error, os.strerror(error)))
+            return
+
+        state['done'] = True
+        for loser in attempts:
+            if loser is not s:
+                reactor.close_session(loser)
+        await async_callback(s)
+
+    def start_next_attempt():
+        if state['done'] or not pending:
+            return
+        address = pending.pop(0)
+        try:
+            client_socket = socket.socket(address.family, socket.SOCK_STREAM)
+        except OSError as err:
+            attempt_failed(err)
+            return
+        try:
+            client_socket.setblocking(False)
+            err = client_socket.connect_ex(address.sockaddr)
+        except (OSError, OverflowError, ValueError) as error:
+            # e.g. OverflowError for a port over 65535
+            client_socket.close()
+            attempt_failed(error)
+            return
+        if err not in (0, errno.EINPROGRESS):
+            client_socket.close()
+            attempt_failed(ConnectionError(err, os.strerror(err)))
+            return
 
-            while not result_part:
-                result_part = session.file.readline()
-                result_buffer += result_part
+        attempts.append(reactor.add_client_socket_and_callback(client_socket, attempt_callback))  # line:b4g9a
+        if pending:
+            reactor.call_later(attempt_delay, start_next_attempt)
 
-            Reactor.get_instance().make_progress(session, result_buffer, IOIntention.none)
-        res = yield receive_response_inner
-        return res
+    def give_up():
+        if not state['done']:
+            finish_with_error(state['last_error'] or TimeoutError("connection timed out"))
 
+    def cancel():
+        state['done'] = True
+        for attempt_session in attempts:
+            reactor.close_session(attempt_session)
+
+    start_next_attempt()
+    reactor.call_later(timeout, give_up)
+    return cancel
+
+
+def start_http_get(url, port=80, on_response: Callable[[str], Any] = None,
+                   on_error: Callable[[OSError], Any] = None):
+    """Callback flavour of `simple_http_get`, which doesn't block the calling session
+
+    Returns right away. The request runs in its own session, and `on_response(response)`
+    is called once the response arrives (or `on_error(exception)` if the port is invalid,
+    the name can't be resolved, or no address accepts the connection). Use this to have
+    many requests in flight at once.
+
+    Returns a function which cancels the request. Neither callback gets called after that.
+    """
+    state = {'cancelled': False, 'cancel_connection': None}
     async def make_http_request(s: Session):
         # TODO - make the request using the proper path, not just /
         raw_request = (
@@ -73,27 +281,174 @@ def simple_http_get(url, port=80, headers=None):
             b"Reach-me-at: vlad.george.ardelean@gmail.com\r\n"
             b"\r\n"
         )
-        none = await send_request(raw_request)
-        response = await receive_response(none)
+        sent = await _send_request(raw_request)
+        if isinstance(sent, OSError):
+            on_error(sent)
+            return
+        response = await _receive_response(sent)
+
+        if isinstance(response, OSError):
+            on_error(response)
+        elif not response:
+            on_error(ConnectionError(f"{url} closed the connection without responding"))
+        else:
+            on_response(response)
+
+    def on_resolved(addresses: list[Address]):
+        if not state['cancelled']:
+            state['cancel_connection'] = connect_happy_eyeballs(addresses, make_http_request, on_error)
+
+    def on_resolve_error(err: OSError):
+        if not state['cancelled']:
+            on_error(err)
+
+    def cancel():
+        state['cancelled'] = True
+        if state['cancel_connection']:
+            state['cancel_connection']()
+
+    try:
+        # the port might come straight from a command line, as a string
+        port = int(port)
+        if not 0 < port < 65536:
+            # getaddrinfo() would wrap it around (70000 -> 4464), connect() would raise OverflowError
+            raise ValueError(f"port must be 1-65535, not {port}")
+    except (TypeError, ValueError) as err:
+        # on the next tick, like any other error: the caller isn't expecting callbacks just yet
+        Reactor.get_instance().call_soon(lambda error=err: on_resolve_error(error))
+        return cancel
+
+    # resolving on the reactor thread (which socket.connect() would do) blocks every session
+    Resolver.get_instance().resolve(url, port, on_resolved, on_resolve_error)
+    return cancel
+
+
+@types.coroutine
+def simple_http_get(url, port=80, headers=None):
+    """Simple interface to make an HTTP GET request
+
+     Return the entire request (line,headers,body) as raw bytes
+     """
+    calling_session = Reactor.get_instance().get_current_session()
 
+    def continue_calling_session(response):
         # see the `response` here? We're basically throwing that to line marked `3mfn5gwf`,
         # as the result. The generator for the original session which wanted to make an HTTP
         # call paused on line marked `3mfn5gwf`. We then set a callback on another socket on
         # line marked `b4g9a`. The callback is this function. When this function completes
         # and we have our result, we basically restart the previous generator with that result
-        Reactor.get_instance().make_progress(calling_session, response, IOIntention.none)
+        _unpark(calling_session, response)
 
-    Reactor.get_instance().add_client_socket_and_callback(client_socket, make_http_request)  # line:b4g9a
+    def fail_calling_session(err: OSError):
+        # the exception is raised by the `yield` below, in the calling session
+        _unpark(calling_session, err)
+
+    start_http_get(url, port, continue_calling_session, fail_calling_session)
 
     # `yield` works very well, BUT, I think that's just by accident.
     #  Sure, the `make_http_request` function will trigger progress, and make line 3mfn5gwf get
     #  the result and continue, but what if the socket in the initial session triggers first?
-    #  ...then, the reactor will call the `yield`ed value, and this would blow up, because
-    #  that result is None. That is why we still return a noop, which doesn't do any progress
-    #  but is required for respecting the expectations of the reactor.
-    result = yield noop  # line: 3mfn5gwf
+    #  ...then, the reactor would call the `yield`ed value. So the session doesn't wait on its
+    #  socket at all meanwhile (see _park), and we still yield something callable, just in case.
+    calling_session.io_intention = IOIntention.none
+    result = yield _park  # line: 3mfn5gwf
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+@types.coroutine
+def fan_out_http_get(
+        targets: list[tuple[str, int]],
+        on_result: Callable[[tuple[str, int], Any, float], Any],
+        timeout: float = 10.0,
+        deadline: float = 30.0,
+        concurrency: int = 10,
+):
+    """Make HTTP GET requests to all the (host, port) `targets` concurrently
+
+    `on_result(target, response_or_exception, seconds)` is called as each one completes,
+    so results can be streamed back right away. At most `concurrency` requests are in flight
+    at once, each one gets `timeout` seconds, and whatever isn't done after `deadline` seconds
+    fails with a TimeoutError. Returns (to the awaiting session) when all of them are done.
+    """
+    if concurrency < 1:
+        raise ValueError(f"concurrency must be at least 1, not {concurrency}")
+    reactor = Reactor.get_instance()
+    calling_session = reactor.get_current_session()
+
+    waiting = list(enumerate(targets))
+    # target index -> (cancel function, start time)
+    running = {}  # type: dict[int, tuple[Callable[[], Any], float]]
+    state = {'finished': False}
+
+    def maybe_finish():
+        if not waiting and not running and not state['finished']:
+            state['finished'] = True
+            _unpark(calling_session, None)
+
+    def complete(index, result):
+        if index not in running:
+            # already timed out, or completed
+            return
+        cancel, started = running.pop(index)
+        if isinstance(result, TimeoutError):
+            cancel()
+        try:
+            on_result(targets[index], result, time.monotonic() - started)
+        finally:
+            launch()
+            maybe_finish()
+
+    def launch():
+        while waiting and len(running) < concurrency:
+            index, (host, port) = waiting.pop(0)
+            running[index] = (noop, time.monotonic())
+            cancel = start_http_get(
+                host, port,
+                lambda response, i=index: complete(i, response),
+                lambda err, i=index: complete(i, err),
+            )
+            running[index] = (cancel, running[index][1])
+            reactor.call_later(timeout, lambda i=index: complete(i, TimeoutError(f"no response after {timeout}s")))
+
+    def deadline_reached():
+        for index, target in waiting:
+            on_result(target, TimeoutError("deadline reached before the request started"), 0.0)
+        waiting.clear()
+        for index in list(running):
+            complete(index, TimeoutError(f"deadline of {deadline}s reached"))
+        maybe_finish()
+
+    if not targets:
+        return None
+
+    launch()
+    reactor.call_later(deadline, deadline_reached)
+
+    # same trick as in simple_http_get: the requests' callbacks resume us when they're done
+    calling_session.io_intention = IOIntention.none
+    result = yield _park
     return result
 
 
 def noop(*args, **kwargs):
     pass
+
+
+def _park(session: Session):
+    """What a session yields while some other callback is going to resume it
+
+    Its own socket doesn't matter until then, so it's not selected at all. Otherwise a pipelined
+    line, or the client hanging up, would have the reactor call this on every tick.
+    """
+    session.io_intention = IOIntention.none
+
+
+def _unpark(session: Session, result):
+    """Resume a session that yielded _park, with `result`"""
+    reactor = Reactor.get_instance()
+    # same as when the rate limiter lets a session read again: unless it's gone meanwhile
+    if reactor.sessions.get(session.socket) is session:
+        session.io_intention = IOIntention.read
+    reactor.make_progress(session, result, IOIntention.read)
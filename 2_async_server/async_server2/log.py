@@ -0,0 +1,185 @@
+"""
+Buffered, structured logging that stays off the reactor thread.
+
+print() is a synchronous write to stdout, and when stdout is a pipe, it ends up costing more
+than handling the line we're printing about. Here, logging a record is just appending a tuple
+to a deque (atomic in CPython, so no lock). A background thread formats the records and writes
+them in batches.
+
+- records below the logger's level are dropped before anything else happens
+- formatting is lazy: `message % args` only runs on the background thread
+- high-frequency events can be sampled: `sample=100` keeps 1 record in 100, per event
+- when the queue is full, records are dropped (and counted) instead of blocking the reactor
+- if the stream can't be written to, those records are dropped too. The thread keeps going
+
+Output is one line per record: time, level, event, message, then key=value fields
+
+    2024-01-01T12:00:00.123 INFO connected address=('127.0.0.1', 5555)
+"""
+import atexit
+import collections
+import enum
+import sys
+import threading
+import time
+import traceback
+from typing import Optional, TextIO
+
+
+class Level(enum.IntEnum):
+    debug = 10
+    info = 20
+    warning = 30
+    error = 40
+
+
+class Logger:
+    _instance: "Logger" = None
+
+    def __init__(self, level: Level = Level.info, stream: Optional[TextIO] = None,
+                 max_queue: int = 10000, flush_interval: float = 0.05):
+        """
+        :param stream: where to write. None means whatever sys.stdout is at the time of writing
+        :param max_queue: records waiting to be written, before we start dropping them
+        :param flush_interval: how often the background thread writes, in seconds
+        """
+        self.level = level
+        self.stream = stream
+        self.max_queue = max_queue
+        self.flush_interval = flush_interval
+
+        self._queue = collections.deque()  # type: collections.deque[tuple]
+        self._sample_counts = collections.Counter()  # type: collections.Counter[str]
+
+        self.dropped = 0
+        self.sampled_out = 0
+        self.write_errors = 0
+        self._reported_dropped = 0
+
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None  # type: Optional[threading.Thread]
+
+    @classmethod
+    def get_instance(cls) -> "Logger":
+        if not cls._instance:
+            cls._instance = cls()
+
+        return cls._instance
+
+    def log(self, level: Level, event: str, message: str = '', *args, sample: int = 1, **fields):
+        if level < self.level:
+            return
+
+        if sample > 1:
+            self._sample_counts[event] += 1
+            if self._sample_counts[event] % sample != 1:
+                self.sampled_out += 1
+                return
+            fields['sampled'] = f"1/{sample}"
+
+        if len(self._queue) >= self.max_queue:
+            self.dropped += 1
+            return
+
+        exc_info = fields.pop('exc_info', None)
+        self._queue.append((time.time(), level, event, message, args, fields, exc_info))
+
+        if self._thread is None:
+            self._start()
+
+    def debug(self, event: str, message: str = '', *args, **fields):
+        self.log(Level.debug, event, message, *args, **fields)
+
+    def info(self, event: str, message: str = '', *args, **fields):
+        self.log(Level.info, event, message, *args, **fields)
+
+    def warning(self, event: str, message: str = '', *args, **fields):
+        self.log(Level.warning, event, message, *args, **fields)
+
+    def error(self, event: str, message: str = '', *args, **fields):
+        self.log(Level.error, event, message, *args, **fields)
+
+    def exception(self, event: str, message: str = '', *args, **fields):
+        """Like .error, plus the traceback of the exception being handled"""
+        self.log(Level.error, event, message, *args, exc_info=sys.exc_info(), **fields)
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run, name='logger', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+        # close() might have come in while we were in flush(), right after it emptied the queue
+        self.flush()
+
+    def flush(self):
+        """Write out everything queued so far. Called by the background thread"""
+        lines = []
+        while self._queue:
+            lines.append(self._format(*self._queue.popleft()))
+
+        if not lines:
+            return
+        records, reported_dropped = len(lines), self._reported_dropped
+        if self.dropped != self._reported_dropped:
+            lines.append(self._format(
+                time.time(), Level.warning, 'log_records_dropped', '', (),
+                {'count': self.dropped - self._reported_dropped, 'total': self.dropped}, None
+            ))
+            self._reported_dropped = self.dropped
+
+        stream = self.stream or sys.stdout
+        try:
+            stream.write(''.join(lines))
+            stream.flush()
+        except Exception as err:
+            # e.g. a closed pipe, or a full disk. Don't take the logging thread down with it.
+            # The records are lost, and the next write that works says so
+            self.dropped += records
+            self._reported_dropped = reported_dropped
+            self.write_errors += 1
+            if self.write_errors == 1:
+                try:
+                    sys.__stderr__.write(f"Logger can't write to {stream!r}: {type(err).__name__}: {err}\n")
+                except Exception:
+                    pass
+
+    @staticmethod
+    def _format(timestamp, level, event, message, args, fields, exc_info) -> str:
+        parts = [
+            time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(timestamp)) + f".{int(timestamp % 1 * 1000):03d}",
+            level.name.upper(),
+            event,
+        ]
+        if message:
+            try:
+                parts.append(message % args if args else message)
+            except (TypeError, ValueError) as err:
+                parts.append(f"{message!r} % {args!r} ({err})")
+        parts.extend(f"{key}={value}" for key, value in fields.items())
+
+        line = ' '.join(parts) + '\n'
+        if exc_info and exc_info[0] is not None:
+            line += ''.join(traceback.format_exception(*exc_info))
+        return line
+
+    def close(self):
+        """Stop the background thread, after it wrote everything"""
+        if self._thread is None:
+            return
+        self._stopped = True
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+        self._stopped = False
+
+    def report(self) -> str:
+        return (
+            f"Logging: {len(self._queue)} queued, {self.dropped} dropped, "
+            f"{self.sampled_out} sampled out, {self.write_errors} write errors"
+        )
@@ -2,10 +2,43 @@
 Check __init__.py for documentation/usage
 """
 import dataclasses
+import itertools
+import math
+import os
+import socket
+import time
+import urllib.parse
 from typing import Callable, Coroutine, Any
 
 from .server import Reactor, create_async_server_socket, Session
-from .io import readline, simple_http_get
+from . import compression
+from .framing import PREAMBLE, RESPONSE, FrameReader, Opcode, ProtocolError, pack_frame
+from .log import Logger
+from .io import fan_out_http_get, readline, recv_some, start_http_get
+from .profiler import SamplingProfiler, install_toggle_signal
+from .ratelimit import Limit, RateLimiter
+from .websocket import upgrade
+
+
+logger = Logger.get_instance()
+
+# log 1 in this many received lines
+LINE_LOG_SAMPLE = 100
+
+# seconds a binary `http` request gets, unless it says otherwise
+BINARY_HTTP_TIMEOUT = 10.0
+
+# One `http` command can't ask for more than this. Every request in flight is a socket (two,
+# while happy eyeballs races IPv6 with IPv4), and select() can't take fds past 1023
+MAX_HTTP_LIMIT = 50
+MAX_HTTP_URLS = 50
+# async requests a binary session can have in flight at once. Past that, they're refused
+MAX_BINARY_IN_FLIGHT = 50
+
+# `stats` and `profile` only work for sessions on this unix socket: they tell a lot about the
+# other clients, and the profiler slows everyone down. Only our user can connect to it:
+#   $ nc -U async_server2-admin.sock
+ADMIN_SOCKET = 'async_server2-admin.sock'
 
 
 @dataclasses.dataclass
@@ -27,51 +60,236 @@ class Command:
         return self.func(*args)
 
     @staticmethod
-    async def handle_command_async(*args) -> Coroutine[Any, Any, bytes]:
-        result = await simple_http_get(*args)  # todo - fix typing
+    async def handle_command_async(s: Session, *args) -> Coroutine[Any, Any, bytes]:
+        """Fetch all the URLs in `args` concurrently, writing each result to `s` as it comes
+
+        Returns a summary, once they're all done
+        """
+        targets, options = parse_http_args(args)
+        counts = {'ok': 0, 'failed': 0}
+
+        def write_result(target, result, seconds):
+            url = b"%s:%d" % (target[0].encode(), target[1])
+            if isinstance(result, Exception):
+                counts['failed'] += 1
+                s.write(b"<%s failed after %.1fms: %s>\r\n\r\n" % (url, seconds * 1000, str(result).encode()))
+            else:
+                counts['ok'] += 1
+                s.write(b"%s responded after %.1fms:\r\n%s\r\n\r\n" % (url, seconds * 1000, result.encode()))
+
+        started = time.monotonic()
+        await fan_out_http_get(targets, write_result, **options)  # todo - fix typing
+
+        return b"<%d ok, %d failed, in %.1fms>\r\n\r\n" % (
+            counts['ok'], counts['failed'], (time.monotonic() - started) * 1000
+        )
+
+    @staticmethod
+    def start_command_async(on_result: Callable[[bytes], Any], on_error: Callable[[Exception], Any], *args):
+        """Like .handle_command_async, but doesn't block the session: calls on_result (or on_error) later
+
+        Returns a function which cancels the command
+        """
+        return start_http_get(*args, on_response=lambda result: on_result(result.encode()), on_error=on_error)
 
-        return b"after making the response, got:\r\n" + result.encode() + b"\r\n\r\n"
+
+def parse_http_args(args) -> tuple[list[tuple[str, int]], dict]:
+    """`http` command arguments: URLs, and options
+
+        http example.com python.org:80 http://localhost:8080/ timeout=2 deadline=10 limit=5
+
+    A number on its own is the port of the URL before it (`http example.com 8080`)
+    """
+    option_names = {'timeout': ('timeout', float), 'deadline': ('deadline', float), 'limit': ('concurrency', int)}
+    targets = []
+    options = {}
+    for arg in args:
+        name, equals, value = arg.partition('=')
+        if equals and name in option_names:
+            option, type_ = option_names[name]
+            value = type_(value)
+            if option == 'concurrency' and not 1 <= value <= MAX_HTTP_LIMIT:
+                # < 1: nothing would ever start, and it'd all fail at the deadline
+                raise ValueError(f"limit must be 1-{MAX_HTTP_LIMIT}, not {value}")
+            if option != 'concurrency' and not (math.isfinite(value) and value >= 0):
+                raise ValueError(f"{name} must be 0 seconds or more, not {value}")
+            options[option] = value
+        elif arg.isdigit() and targets:
+            port = int(arg)
+            if not 0 < port < 65536:
+                # same as what urlsplit() says about host:70000
+                raise ValueError(f"port must be 1-65535, not {port}")
+            targets[-1] = (targets[-1][0], port)
+        else:
+            if '://' not in arg:
+                arg = 'http://' + arg
+            url = urllib.parse.urlsplit(arg)
+            if not url.hostname:
+                raise ValueError(f"not a URL: {arg}")
+            targets.append((url.hostname, url.port or 80))
+            if len(targets) > MAX_HTTP_URLS:
+                raise ValueError(f"at most {MAX_HTTP_URLS} URLs at once")
+    return targets, options
 
 
 def handle_http(url_bytes) -> bytes:
-    print(f"dummy: handling HTTP GET for url {url_bytes}")
+    logger.debug('dummy_http', "dummy: handling HTTP GET for url %s", url_bytes)
 
     return b"dummy handler of HTTP -> to be implemented\r\n\r\n"
 
 
+cmd_upper = 'upper'
+cmd_title = 'title'
+cmd_lower = 'lower'
+cmd_http = 'http'
+
+# shared by the line protocol and the binary one
+possible_modes = {
+    cmd_upper: Command(cmd_upper, bytes.upper, ),
+    cmd_title: Command(cmd_title, bytes.title, ),
+    cmd_lower: Command(cmd_lower, bytes.lower, ),
+}
+commands = {
+    cmd_http: Command(cmd_http, handle_http, is_async=True),
+}
+binary_opcodes = {
+    Opcode.upper: possible_modes[cmd_upper],
+    Opcode.lower: possible_modes[cmd_lower],
+    Opcode.title: possible_modes[cmd_title],
+    Opcode.http: commands[cmd_http],
+}
+
+
+async def binary_command_server(s: Session):
+    """The binary protocol from framing.py. Check that module for the details"""
+    if s.socket.family in (socket.AF_INET, socket.AF_INET6):
+        # responses are small and pipelined. Nagle would hold them back waiting for ACKs
+        s.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    s.write(PREAMBLE)
+
+    reactor = Reactor.get_instance()
+    reader = FrameReader()
+    # requests still waiting for their response: request_id -> a number unique to the request.
+    # Request ids get reused, and a late callback shouldn't answer a newer request with the same id
+    in_flight = {}  # type: dict[int, int]
+    request_numbers = itertools.count()
+
+    def respond(opcode, request_id, payload, number=None):
+        # the session might have quit while a slow request was in flight
+        if request_id in in_flight and number in (None, in_flight[request_id]):
+            del in_flight[request_id]
+            s.write(pack_frame(opcode | RESPONSE, request_id, payload))
+
+    def fail(request_id, message: str):
+        in_flight.pop(request_id, None)
+        s.write(pack_frame(Opcode.error, request_id, message.encode()))
+
+    def fail_in_flight(request_id, number, err: Exception):
+        if in_flight.get(request_id) == number:
+            fail(request_id, f"{type(err).__name__}: {err}")
+
+    try:
+        while True:
+            data = await recv_some()
+            if not data:
+                return
+
+            try:
+                frames = reader.feed(data)
+            except ProtocolError as err:
+                fail(0, str(err))
+                return
+
+            for opcode, request_id, payload in frames:
+                if opcode == Opcode.quit:
+                    s.write(pack_frame(Opcode.quit | RESPONSE, request_id))
+                    return
+                if opcode not in binary_opcodes:
+                    fail(request_id, f"unknown opcode {opcode}")
+                    continue
+                if request_id in in_flight:
+                    fail(request_id, f"request id {request_id} is already in flight")
+                    continue
+
+                cmd = binary_opcodes[opcode]
+                # sync requests are answered right away, so whatever's in flight is async
+                if cmd.is_async and len(in_flight) >= MAX_BINARY_IN_FLIGHT:
+                    fail(request_id, f"too many requests in flight (at most {MAX_BINARY_IN_FLIGHT})")
+                    continue
+
+                number = in_flight[request_id] = next(request_numbers)
+                if not cmd.is_async:
+                    respond(opcode, request_id, cmd.handle_command(payload))
+                    continue
+
+                # b"<host> [<port>] [timeout=<seconds>]", checked just like the line protocol's `http`
+                try:
+                    targets, options = parse_http_args(payload.decode('utf-8', 'replace').split())
+                    if len(targets) != 1:
+                        raise ValueError(f"expected 1 URL, got {len(targets)}")
+                except ValueError as err:
+                    fail_in_flight(request_id, number, err)
+                    continue
+
+                cancel = cmd.start_command_async(
+                    lambda result, opcode=opcode, request_id=request_id, number=number:
+                        respond(opcode, request_id, result, number),
+                    lambda err, request_id=request_id, number=number: fail_in_flight(request_id, number, err),
+                    *targets[0]
+                )
+
+                # an upstream that accepts, but never answers, would keep the request in flight forever
+                timeout = options.get('timeout', BINARY_HTTP_TIMEOUT)
+
+                def timed_out(request_id=request_id, number=number, cancel=cancel, timeout=timeout):
+                    if in_flight.get(request_id) == number:
+                        cancel()
+                        fail_in_flight(request_id, number, TimeoutError(f"no response after {timeout}s"))
+
+                reactor.call_later(timeout, timed_out)
+    finally:
+        in_flight.clear()
+
+
+def is_admin(s: Session) -> bool:
+    # a unix socket means a local user, and the socket file's permissions say which (see ADMIN_SOCKET)
+    return s.socket.family == socket.AF_UNIX
+
+
 async def command_server(s: Session):
     cmd_quit = 'quit'
-    cmd_upper = 'upper'
-    cmd_title = 'title'
-    cmd_lower = 'lower'
-    cmd_http = 'http'
     cmd_help = 'help'
-
-    possible_modes = {
-        cmd_upper: Command(cmd_upper, bytes.upper, ),
-        cmd_title: Command(cmd_title, bytes.title, ),
-        cmd_lower: Command(cmd_lower, bytes.lower, ),
-    }
-    commands = {
-        cmd_http: Command(cmd_help, handle_http, is_async=True),
-    }
+    cmd_stats = 'stats'
+    cmd_profile = 'profile'
+    cmd_compress = 'compress'
+    cmd_decompress = 'decompress'
+    cmd_binary = PREAMBLE.decode().strip()
 
     mode = cmd_upper
     # calling this function looks too low-level.
     # Let's make the handler receive a Session instead
-    print(f"Received connection from {s.address}")
+    logger.info('connected', address=s.address)
 
     try:
         s.write(b"<Welcome to the echo-server! Starting in upper case mode>\r\n")
         s.write(b"<To see the available commands, type \"help\" and press return>\r\n\r\n")
 
         while True:
-            line = (await readline()).strip()
+            line = await readline()
+            if not line:
+                # the client went away
+                return
+            line = line.strip()
 
             if line == cmd_quit:
                 s.write(b"bye!\r\n")
                 return
 
+            if line == cmd_binary:
+                # a programmatic client. The rest of the session uses the binary protocol
+                await binary_command_server(s)
+                return
+
             if line == cmd_help:
                 s.write(
                     b"Available commands: \r\n"
@@ -80,9 +298,59 @@ async def command_server(s: Session):
                     b"upper - sets the echoing mode to UPPER case\r\n"
                     b"lower - sets the echoing mode to lower case\r\n"
                     b"title - sets the echoing mode to Title case\r\n"
-                    b"http <url> - make a HTTP GET request to <url> and print the response line & headers\n\r"
-                    b"\r\n"
+                    b"http <url> [<url> ...] [timeout=10] [deadline=30] [limit=10] - make HTTP GET requests "
+                    b"to all the <url>s concurrently, and print each response line as it arrives\r\n"
+                    b"compress [level] - everything after the reply is compressed (raw deflate, "
+                    b"flushed after each message). Level 0-9, default 6\r\n"
+                    b"decompress - everything sent after this command should be compressed (raw deflate)\r\n"
                 )
+                if is_admin(s):
+                    s.write(
+                        b"stats - shows the CPU time used per handler and per session, rate limiting "
+                        b"and logging stats\r\n"
+                        b"profile - starts/stops the sampling profiler\r\n"
+                    )
+                s.write(b"\r\n")
+            elif line in (cmd_stats, cmd_profile) and not is_admin(s):
+                s.write(b"<%s is only available on the admin socket>\r\n\r\n" % line.encode())
+            elif line == cmd_stats:
+                reactor = Reactor.get_instance()
+                report = reactor.cpu_report()
+                if reactor.rate_limiter:
+                    report += "\n" + reactor.rate_limiter.report()
+                report += "\n" + logger.report()
+                compression_layer = compression.get_layer(s)
+                if compression_layer:
+                    report += "\n" + compression_layer.report()
+                s.write(report.replace('\n', '\r\n').encode() + b"\r\n\r\n")
+            elif line == cmd_profile:
+                try:
+                    output_path = SamplingProfiler.get_instance().toggle()
+                except ValueError as err:
+                    # signal handlers can only be set on the main thread, and the reactor might not be on it
+                    s.write(b"<profile failed: %s>\r\n\r\n" % str(err).encode())
+                else:
+                    if output_path:
+                        s.write(b"<Profiler stopped, collapsed stacks written to %s>\r\n\r\n" % output_path.encode())
+                    else:
+                        s.write(b"<Profiler started>\r\n\r\n")
+            elif line.split(' ')[0] == cmd_compress:
+                level = line[len(cmd_compress):].strip() or compression.DEFAULT_LEVEL
+                try:
+                    level = int(level)
+                    compression.check_level(level)
+                    # the reply is the last thing the client gets uncompressed (or at the previous level)
+                    s.write(b"<Compressing the output at level %d>\r\n\r\n" % level)
+                    compression.compress_output(s, level)
+                except ValueError as err:
+                    s.write(b"<compress failed: %s>\r\n\r\n" % str(err).encode())
+            elif line == cmd_decompress:
+                s.write(b"<Decompressing the input>\r\n\r\n")
+                try:
+                    compression.decompress_input(s)
+                except ConnectionAbortedError as err:
+                    s.write(b"<decompress failed: %s>\r\n\r\n" % str(err).encode())
+                    return
             elif line in possible_modes:
                 for mode_candidate in possible_modes:
                     if mode is not mode_candidate and line == mode_candidate:
@@ -95,7 +363,10 @@ async def command_server(s: Session):
                     if line_parts[0] in commands:
                         cmd = commands[line_parts[0]]
                         if cmd.is_async:
-                            result = await cmd.handle_command_async(*line_parts[1:])
+                            try:
+                                result = await cmd.handle_command_async(s, *line_parts[1:])
+                            except (OSError, ValueError) as err:
+                                result = b"<%s failed: %s>\r\n\r\n" % (cmd.name.encode(), str(err).encode())
                         else:
                             result = cmd.handle_command(*line_parts[1:])
 
@@ -105,15 +376,30 @@ async def command_server(s: Session):
                 else:
                     s.write(possible_modes[mode].echo_msg(line.encode('utf-8')))
 
-            print(f"From {s.address} got {line}")
+            # one of these per line, so keep only a sample
+            logger.info('line_received', "%r", line, address=s.address, sample=LINE_LOG_SAMPLE)
     finally:
-        print(f"{s.address} quit")
+        compression_layer = compression.get_layer(s)
+        if compression_layer:
+            logger.info('compression', "%s", compression_layer.report().replace('\n', ';'), address=s.address)
+        logger.info('quit', address=s.address)
 
 
 if __name__ == '__main__':
     reactor = Reactor.get_instance()
+    install_toggle_signal()
+    reactor.rate_limiter = RateLimiter(
+        session_lines=Limit(rate=200, burst=400),
+        session_bytes=Limit(rate=256 * 1024, burst=1024 * 1024),
+        address_lines=Limit(rate=1000, burst=2000),
+        address_bytes=Limit(rate=1024 * 1024, burst=4 * 1024 * 1024),
+    )
 
     server_socket = create_async_server_socket('localhost', 1848, reuse=True)
     reactor.add_server_socket_and_callback(server_socket, command_server)
+    # the same thing, for browsers
+    reactor.add_server_socket_and_callback(('localhost', 1851, True), upgrade(command_server))
+    reactor.add_server_socket_and_callback((ADMIN_SOCKET, None, True), command_server)
+    os.chmod(ADMIN_SOCKET, 0o600)
 
     reactor.start_reactor()
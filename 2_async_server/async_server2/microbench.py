@@ -0,0 +1,307 @@
+"""
+Microbenchmarks for the reactor internals: no network, no real waiting.
+
+Sessions talk to in-memory socketpairs, the reactor is driven one tick at a time with
+Reactor.run_once(), and scheduled events run on a virtual clock (so the timer benchmark
+doesn't sleep, and doesn't depend on how busy the machine is). What's measured:
+
+- tick: one reactor tick, with N idle command_server sessions waiting for a line
+- await: one await round trip (the reactor calls the session's callback, which resumes the coroutine)
+- line: one line through command_server, from the read buffer to the echoed response
+- timers: scheduling an event with call_later, and running it once it's due
+
+Within a run, each benchmark repeats a few times and the fastest repeat counts. Still, whole runs
+can be 25-40% apart on a busy machine, so the suite runs --runs times, and both the baseline and
+the comparison go by the median of the runs, with the spread (MAD: median absolute deviation)
+of the runs telling how much movement is just noise:
+
+$ python -m async_server2.microbench --save baseline.json
+$ python -m async_server2.microbench --save baseline.json   # a bit later: adds its runs to the baseline
+..change things, then
+$ python -m async_server2.microbench --compare baseline.json
+
+--compare exits with 1 if a median got slower than the baseline's by more than
+--tolerance + NOISE_MADS times the MADs of both. Runs of the same invocation move together,
+so save the baseline from 2-3 invocations: its MAD then knows how much they move apart.
+Baselines only mean something on the machine they were saved on.
+"""
+import argparse
+import collections
+import contextlib
+import gc
+import itertools
+import json
+import os
+import socket
+import statistics
+import sys
+import time
+import types
+from typing import Callable, Iterator
+
+from .log import Level, Logger
+from .main import command_server
+from .server import IOIntention, Reactor, Session
+
+END_OF_MESSAGE = b"\r\n\r\n"
+
+# How many MADs apart two medians can be, before it's more than noise
+NOISE_MADS = 3
+
+logger = Logger.get_instance()
+
+
+class VirtualClock:
+    """A stand-in for time.monotonic that only moves when told to"""
+
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += seconds
+
+
+class Harness:
+    """A fresh Reactor (installed as THE reactor), with sessions connected to socketpairs"""
+
+    def __init__(self):
+        self.clock = VirtualClock()
+        self.reactor = Reactor()
+        self.reactor.clock = self.clock
+        # the other end of each session's socket: what the "client" holds
+        self.peers = {}  # type: dict[Session, socket.socket]
+
+    def connect(self, handler) -> Session:
+        ours, theirs = socket.socketpair()
+        ours.setblocking(False)
+        theirs.setblocking(False)
+        address = f"fake:{len(self.peers)}"
+        self.reactor._connect(ours, address, handler, IOIntention.read)  # noqa
+        session = self.reactor.sessions[ours]
+        self.peers[session] = theirs
+        self.drain(session)
+        return session
+
+    def drain(self, session: Session) -> bytes:
+        """Whatever `session` wrote so far"""
+        peer = self.peers[session]
+        chunks = []
+        try:
+            while True:
+                chunk = peer.recv(256 * 1024)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except BlockingIOError:
+            pass
+        return b''.join(chunks)
+
+    def close(self):
+        for session, peer in self.peers.items():
+            self.reactor.close_session(session)
+            peer.close()
+        self.reactor._wakeup_reader.close()  # noqa
+        self.reactor._wakeup_writer.close()  # noqa
+
+
+@contextlib.contextmanager
+def harness() -> Iterator[Harness]:
+    previous_reactor, previous_level = Reactor._instance, logger.level
+    bench = Harness()
+    Reactor._instance = bench.reactor
+    # 'connected', 'quit'... would otherwise be most of what we measure
+    logger.level = Level.warning
+    try:
+        yield bench
+    finally:
+        bench.close()
+        Reactor._instance = previous_reactor
+        logger.level = previous_level
+
+
+def measure(run: Callable[[], int], repeat: int) -> tuple[float, float]:
+    """Run `run` `repeat` times. It returns how many operations it did.
+
+    Returns (fastest, median) seconds per operation
+    """
+    per_operation = []
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            operations = run()
+            per_operation.append((time.perf_counter() - started) / operations)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return min(per_operation), statistics.median(per_operation)
+
+
+def bench_tick(idle_sessions: int, ticks: int, repeat: int) -> tuple[float, float]:
+    with harness() as bench:
+        for _ in range(idle_sessions):
+            bench.connect(command_server)
+        run_once = bench.reactor.run_once
+
+        def run():
+            for _ in range(ticks):
+                run_once(max_timeout=0)
+            return ticks
+
+        return measure(run, repeat)
+
+
+@types.coroutine
+def _ready_right_away():
+    def inner(session: Session):
+        Reactor.get_instance().make_progress(session, None, IOIntention.read)
+
+    none = yield inner
+    return none
+
+
+async def _awaiter(s: Session):
+    while True:
+        await _ready_right_away()
+
+
+def bench_await(awaits: int, repeat: int) -> tuple[float, float]:
+    with harness() as bench:
+        session = bench.connect(_awaiter)
+        reactor = bench.reactor
+
+        def run():
+            # what the reactor does for a session whose socket is ready, minus the select()
+            for _ in range(awaits):
+                reactor._run_callback(session, session.call_next_callback)  # noqa
+            return awaits
+
+        return measure(run, repeat)
+
+
+def bench_line(lines: int, batch: int, repeat: int) -> tuple[float, float]:
+    with harness() as bench:
+        session = bench.connect(command_server)
+        peer = bench.peers[session]
+        run_once = bench.reactor.run_once
+        payload = b"hello there, how are you\n" * batch
+
+        def run():
+            # in batches, so that the responses always fit in the socketpair's buffer
+            for _ in range(lines // batch):
+                peer.sendall(payload)
+                responses = 0
+                while responses < batch:
+                    run_once(max_timeout=0)
+                    responses += bench.drain(session).count(END_OF_MESSAGE)
+            return lines // batch * batch
+
+        return measure(run, repeat)
+
+
+def bench_timers(events: int, repeat: int) -> tuple[tuple[float, float], tuple[float, float]]:
+    with harness() as bench:
+        reactor, clock = bench.reactor, bench.clock
+        schedule_times, fire_times = [], []
+        # a bound method taking no arguments: about the cheapest task there is
+        task = itertools.count().__next__
+
+        gc.disable()
+        try:
+            for _ in range(repeat):
+                started = time.perf_counter()
+                for i in range(events):
+                    # spread over 10 seconds, in an order that makes the heap do some work
+                    reactor.call_later((i * 7919 % events) / events * 10, task)
+                scheduled = time.perf_counter()
+
+                clock.advance(10)
+                reactor.run_once(max_timeout=0)
+                finished = time.perf_counter()
+                assert not reactor.events, "all the events should have run"
+
+                schedule_times.append((scheduled - started) / events)
+                fire_times.append((finished - scheduled) / events)
+        finally:
+            gc.enable()
+
+        return (
+            (min(schedule_times), statistics.median(schedule_times)),
+            (min(fire_times), statistics.median(fire_times)),
+        )
+
+
+def run_all(repeat: int) -> dict[str, tuple[float, float]]:
+    results = {}
+    # select() only takes fds below 1024, and each session here uses 2
+    for idle_sessions in (0, 10, 100, 400):
+        results[f"tick, {idle_sessions} idle sessions"] = bench_tick(idle_sessions, ticks=1000, repeat=repeat)
+    results["await round trip"] = bench_await(awaits=20000, repeat=repeat)
+    results["command_server line"] = bench_line(lines=5000, batch=500, repeat=repeat)
+    results["call_later"], results["scheduled event run"] = bench_timers(events=10000, repeat=repeat)
+    return results
+
+
+def median_and_mad(values: list[float]) -> tuple[float, float]:
+    median = statistics.median(values)
+    return median, statistics.median(abs(value - median) for value in values)
+
+
+def load_baseline(path: str) -> dict[str, list[float]]:
+    with open(path) as baseline_file:
+        baseline = json.load(baseline_file)
+    # older baselines have a single number per benchmark
+    return {name: values if isinstance(values, list) else [values] for name, values in baseline.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help="repeats of each benchmark, per run")
+    parser.add_argument('--runs', type=int, default=5, help="runs of the whole suite")
+    parser.add_argument('--save', metavar='PATH',
+                        help="add the results to the baseline in PATH (json), creating it if needed")
+    parser.add_argument('--compare', metavar='PATH', help="compare against a baseline written by --save")
+    parser.add_argument('--tolerance', type=float, default=0.05,
+                        help="how much slower than the baseline is still fine, on top of the noise (0.05 = 5%%)")
+    args = parser.parse_args()
+
+    # name -> the fastest repeat of each run
+    runs = collections.defaultdict(list)  # type: dict[str, list[float]]
+    for _ in range(args.runs):
+        for name, (fastest, _) in run_all(args.repeat).items():
+            runs[name].append(fastest)
+
+    baseline = load_baseline(args.compare) if args.compare else {}
+
+    regressions = []
+    for name, values in runs.items():
+        median, mad = median_and_mad(values)
+        line = f"{name:32} {median * 1e6:9.3f}us +- {mad * 1e6:.3f}us"
+        if name in baseline:
+            baseline_median, baseline_mad = median_and_mad(baseline[name])
+            change = median / baseline_median - 1
+            allowed = args.tolerance + NOISE_MADS * (mad + baseline_mad) / baseline_median
+            line += f"  {change:+.1%} vs baseline (noise up to {allowed:.1%})"
+            if change > allowed:
+                regressions.append(name)
+                line += "  <- REGRESSION"
+        print(line)
+
+    if args.save:
+        saved = load_baseline(args.save) if os.path.exists(args.save) else {}
+        for name, values in runs.items():
+            saved.setdefault(name, []).extend(values)
+        with open(args.save, 'w') as baseline_file:
+            json.dump(saved, baseline_file, indent=2)
+
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond the noise: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+A sampling profiler for the reactor, that can be switched on and off while the server runs.
+
+It uses SIGPROF + setitimer(ITIMER_PROF), so it only samples while the process is burning CPU
+(time spent blocked in select() doesn't show up). When it's stopped, no timer is armed and no
+handler is installed, so it costs nothing.
+
+The output is in the "collapsed stacks" format, one stack per line, which can be fed directly
+to flamegraph.pl or speedscope:
+
+    main.py:<module>;server.py:Reactor.start_reactor;server.py:Reactor._run_callback [('127.0.0.1', 5555)];... 42
+
+Usage:
+    $ kill -USR1 <server pid>   # start sampling
+    $ kill -USR1 <server pid>   # stop sampling, and write the collapsed stacks to disk
+
+..or use the `profile` command from a command_server session.
+"""
+import collections
+import os
+import signal
+from types import FrameType
+from typing import Optional
+
+from .log import Logger
+from .server import Reactor, Session
+
+logger = Logger.get_instance()
+
+# Frames of these functions get labelled with the address of the session they're running
+_SESSION_CODES = {
+    Reactor._run_callback.__code__: 'session',  # noqa
+    Session.call_next_callback.__code__: 'self',
+    Session._make_progress.__code__: 'self',  # noqa
+}
+
+
+def _frame_label(frame: FrameType) -> str:
+    code = frame.f_code
+    label = f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+
+    session_var = _SESSION_CODES.get(code)
+    if session_var is not None:
+        session = frame.f_locals.get(session_var)
+        if session is not None:
+            label += f" [{session.address}]"
+
+    # ";" separates frames in the collapsed format
+    return label.replace(';', ':')
+
+
+class SamplingProfiler:
+    _instance: "SamplingProfiler" = None
+
+    def __init__(self, interval: float = 0.005, output_path: str = 'reactor.collapsed'):
+        """
+        :param interval: seconds of CPU time between 2 samples
+        :param output_path: where .stop() writes the collapsed stacks
+        """
+        self.interval = interval
+        self.output_path = output_path
+        self.samples = collections.Counter()  # type: collections.Counter[str]
+        self._previous_handler = None
+
+    @classmethod
+    def get_instance(cls) -> "SamplingProfiler":
+        if not cls._instance:
+            cls._instance = cls()
+
+        return cls._instance
+
+    @property
+    def running(self) -> bool:
+        return self._previous_handler is not None
+
+    def start(self):
+        if self.running:
+            return
+        self.samples.clear()
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self) -> Optional[str]:
+        """Stop sampling and write the collapsed stacks. Returns the path written to"""
+        if not self.running:
+            return None
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler)
+        self._previous_handler = None
+
+        self.write_collapsed(self.output_path)
+        return self.output_path
+
+    def toggle(self) -> Optional[str]:
+        """Start if stopped, stop if started. Returns the output path when stopping"""
+        if self.running:
+            return self.stop()
+        self.start()
+        return None
+
+    def _sample(self, signum, frame: Optional[FrameType]):
+        # The handler's own frame is not on the stack. `frame` is whatever got interrupted
+        stack = []
+        while frame is not None:
+            stack.append(_frame_label(frame))
+            frame = frame.f_back
+
+        self.samples[';'.join(reversed(stack))] += 1
+
+    def write_collapsed(self, path: str):
+        with open(path, 'w') as output:
+            for stack, count in self.samples.most_common():
+                output.write(f"{stack} {count}\n")
+
+
+def install_toggle_signal(profiler: SamplingProfiler = None, signum=signal.SIGUSR1):
+    """Make `signum` start/stop the profiler"""
+    profiler = profiler or SamplingProfiler.get_instance()
+
+    def toggle(_signum, _frame):
+        output_path = profiler.toggle()
+        if output_path:
+            logger.info('profiler_stopped', samples=sum(profiler.samples.values()), path=output_path)
+        else:
+            logger.info('profiler_started')
+
+    signal.signal(signum, toggle)
@@ -0,0 +1,248 @@
+"""
+A TCP proxy on the Reactor: accept a client, connect to the upstream, relay bytes both ways.
+
+The bytes never become Python objects, if possible: on linux, they go socket -> pipe -> socket
+with os.splice(), all inside the kernel. Otherwise, they're copied through a preallocated
+buffer with recv_into() (which still avoids creating a bytes object per read).
+
+Each direction has its own buffer (or pipe). When it's full, we stop reading from that
+direction's source until the destination accepted everything. That's the backpressure,
+and it's driven by each session's IOIntention. When one side closes its half of the
+connection, we forward that with shutdown(SHUT_WR) once everything before it got through,
+and keep relaying the other direction.
+
+Usage:
+$ python -m async_server2.proxy 8000 example.com 80
+
+..then in another shell
+$ curl -i -H 'Host: example.com' http://localhost:8000
+"""
+import argparse
+import fcntl
+import os
+import socket
+import types
+
+from .io import connect_happy_eyeballs
+from .log import Logger
+from .resolver import Address, Resolver
+from .server import Reactor, Session, IOIntention
+
+CAN_SPLICE = hasattr(os, 'splice')
+
+DEFAULT_BUFFER_SIZE = 256 * 1024
+
+logger = Logger.get_instance()
+
+
+class _Direction:
+    """One direction of the relay: what's read from one socket, gets written to the other"""
+
+    def __init__(self, use_splice: bool, buffer_size: int):
+        self.use_splice = use_splice
+        self.buffer_size = buffer_size
+        self.pending = 0  # read, but not written yet
+        self.transferred = 0
+        self.eof = False  # the source closed (its half of) the connection
+        self.shut_down = False  # ...and we passed that on to the destination
+
+        if use_splice:
+            self._pipe_read, self._pipe_write = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+            if hasattr(fcntl, 'F_SETPIPE_SZ'):
+                try:
+                    fcntl.fcntl(self._pipe_write, fcntl.F_SETPIPE_SZ, buffer_size)
+                except OSError:
+                    # over /proc/sys/fs/pipe-max-size. The default (64k) will do
+                    pass
+        else:
+            self._buffer = bytearray(buffer_size)
+            self._view = memoryview(self._buffer)
+            self._start = 0
+
+    @property
+    def done(self):
+        return self.shut_down
+
+    def wants_read(self):
+        # only refill once everything was written: a full buffer is the backpressure
+        return not self.eof and self.pending == 0
+
+    def wants_write(self):
+        return self.pending > 0
+
+    def fill(self, source: socket.socket):
+        """Read as much as fits from `source`. Raises BlockingIOError if there's nothing"""
+        if self.use_splice:
+            received = os.splice(
+                source.fileno(), self._pipe_write, self.buffer_size,
+                flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK,
+            )
+        else:
+            received = source.recv_into(self._view)
+            self._start = 0
+
+        if received == 0:
+            self.eof = True
+        self.pending += received
+
+    def flush(self, destination: socket.socket):
+        """Write as much as `destination` accepts. Raises BlockingIOError if it accepts nothing"""
+        while self.pending:
+            if self.use_splice:
+                sent = os.splice(
+                    self._pipe_read, destination.fileno(), self.pending,
+                    flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK,
+                )
+            else:
+                sent = destination.send(self._view[self._start:self._start + self.pending])
+                self._start += sent
+            self.pending -= sent
+            self.transferred += sent
+
+    def close(self):
+        if self.use_splice:
+            os.close(self._pipe_read)
+            os.close(self._pipe_write)
+        else:
+            self._view.release()
+
+
+class Relay:
+    def __init__(self, client: Session, upstream: Session, use_splice: bool = CAN_SPLICE,
+                 buffer_size: int = DEFAULT_BUFFER_SIZE):
+        self.client = client
+        self.upstream = upstream
+        self.client_to_upstream = _Direction(use_splice, buffer_size)
+        self.upstream_to_client = _Direction(use_splice, buffer_size)
+        self.finished = False
+
+    def _directions(self, session: Session) -> tuple[_Direction, _Direction, Session]:
+        """(what `session` sends, what `session` receives, the other session)"""
+        if session is self.client:
+            return self.client_to_upstream, self.upstream_to_client, self.upstream
+        return self.upstream_to_client, self.client_to_upstream, self.client
+
+    def on_ready(self, session: Session):
+        """`session`'s socket is readable and/or writable. Move whatever can be moved"""
+        outgoing, incoming, peer = self._directions(session)
+        try:
+            self._pump(outgoing, session.socket, peer.socket)
+            self._pump(incoming, peer.socket, session.socket)
+        except OSError:
+            # reset, broken pipe... no point in relaying half of the connection
+            self.finish()
+            return
+
+        if outgoing.done and incoming.done:
+            self.finish()
+            return
+
+        for each_session in (self.client, self.upstream):
+            sends, receives, _ = self._directions(each_session)
+            read, write = sends.wants_read(), receives.wants_write()
+            each_session.io_intention = (
+                IOIntention.read_write if read and write else
+                IOIntention.read if read else
+                IOIntention.write if write else
+                IOIntention.none
+            )
+
+    @staticmethod
+    def _pump(direction: _Direction, source: socket.socket, destination: socket.socket):
+        try:
+            if direction.wants_read():
+                direction.fill(source)
+            if direction.wants_write():
+                direction.flush(destination)
+        except BlockingIOError:
+            pass
+
+        if direction.eof and not direction.pending and not direction.shut_down:
+            # half-close: the destination gets EOF, but can keep sending the other way
+            destination.shutdown(socket.SHUT_WR)
+            direction.shut_down = True
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.client_to_upstream.close()
+        self.upstream_to_client.close()
+
+        reactor = Reactor.get_instance()
+        current = reactor.get_current_session()
+        for session in (self.client, self.upstream):
+            # the current session ends by itself when its _pump_session returns
+            if session is not current:
+                reactor.close_session(session)
+
+
+@types.coroutine
+def _wait_until_ready():
+    def inner(session: Session):
+        Reactor.get_instance().make_progress(session, None, IOIntention.none)
+
+    none = yield inner
+    return none
+
+
+async def _pump_session(s: Session, relay: Relay):
+    while not relay.finished:
+        await _wait_until_ready()
+        relay.on_ready(s)
+
+
+def relay_to(host: str, port: int, use_splice: bool = CAN_SPLICE, buffer_size: int = DEFAULT_BUFFER_SIZE):
+    """Make a handler for Reactor.add_server_socket_and_callback(), relaying to host:port"""
+
+    async def relay_handler(s: Session):
+        reactor = Reactor.get_instance()
+        # don't read from the client before there's somewhere to send it
+        s.io_intention = IOIntention.none
+        relays = []
+
+        async def upstream_connected(upstream: Session):
+            relay = Relay(s, upstream, use_splice, buffer_size)
+            relays.append(relay)
+            # kick things off: the client might have sent something already
+            relay.on_ready(s)
+            await _pump_session(upstream, relay)
+
+        def upstream_failed(err: OSError):
+            logger.warning('upstream_connect_failed', "%s", err, upstream=f"{host}:{port}", address=s.address)
+            reactor.close_session(s)
+
+        def on_resolved(addresses: list[Address]):
+            connect_happy_eyeballs(addresses, upstream_connected, upstream_failed)
+
+        Resolver.get_instance().resolve(host, port, on_resolved, upstream_failed)
+
+        # only woken up once the relay set our intention
+        await _wait_until_ready()
+        relay = relays[0]
+        relay.on_ready(s)
+        await _pump_session(s, relay)
+
+    return relay_handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('listen_port', type=int)
+    parser.add_argument('upstream_host')
+    parser.add_argument('upstream_port', type=int)
+    parser.add_argument('--listen-host', default='localhost')
+    parser.add_argument('--no-splice', action='store_true', help="copy through userspace buffers instead")
+    parser.add_argument('--buffer-size', type=int, default=DEFAULT_BUFFER_SIZE)
+    args = parser.parse_args()
+
+    reactor = Reactor.get_instance()
+    reactor.add_server_socket_and_callback(
+        (args.listen_host, args.listen_port, True),
+        relay_to(args.upstream_host, args.upstream_port, CAN_SPLICE and not args.no_splice, args.buffer_size),
+    )
+    reactor.start_reactor()
+
+
+if __name__ == '__main__':
+    main()
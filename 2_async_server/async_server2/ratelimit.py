@@ -0,0 +1,146 @@
+"""
+Token bucket rate limiting for sessions, so one scripted client can't saturate the reactor.
+
+Limits apply per session and per source address (all the sessions from the same host share
+the address buckets), in lines/sec and bytes/sec. Reads are charged after they happen, so a
+bucket can go into debt. While any bucket of a session is in debt, the Reactor stops selecting
+that session for reading, until the tokens refill.
+
+Usage:
+    reactor.rate_limiter = RateLimiter(session_lines=Limit(rate=100, burst=200))
+"""
+import collections
+import time
+from typing import Any, NamedTuple, Optional
+
+from .server import Session
+
+
+class Limit(NamedTuple):
+    rate: float  # tokens added per second
+    burst: float  # bucket size: how much can be spent at once, after being idle
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated_at')
+
+    def __init__(self, limit: Limit, now: float):
+        self.rate = limit.rate
+        self.burst = limit.burst
+        self.tokens = limit.burst
+        self.updated_at = now
+
+    def charge(self, amount: float, now: float) -> float:
+        """Take `amount` tokens. Returns how many seconds until the bucket is out of debt"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+def source_address(session: Session):
+    """The host part of the address. Unix socket sessions all count as the same source"""
+    if isinstance(session.address, tuple):
+        return session.address[0]
+    return session.address
+
+
+class _AddressBuckets:
+    __slots__ = ('lines', 'bytes', 'session_count')
+
+    def __init__(self, lines, bytes_):
+        self.lines = lines  # type: Optional[TokenBucket]
+        self.bytes = bytes_  # type: Optional[TokenBucket]
+        self.session_count = 0
+
+
+class RateLimiter:
+    def __init__(
+            self,
+            session_lines: Limit = None,
+            session_bytes: Limit = None,
+            address_lines: Limit = None,
+            address_bytes: Limit = None,
+            clock=time.monotonic,
+    ):
+        """Each limit is optional. Leave it out and that thing isn't limited"""
+        self.session_lines = session_lines
+        self.session_bytes = session_bytes
+        self.address_lines = address_lines
+        self.address_bytes = address_bytes
+        self.clock = clock
+
+        # session -> (lines bucket, bytes bucket)
+        self._session_buckets = {}  # type: dict[Session, tuple[Optional[TokenBucket], Optional[TokenBucket]]]
+        self._address_buckets = {}  # type: dict[Any, _AddressBuckets]
+
+        # How many times a session got throttled, by the bucket that ran out.
+        # by_address counts per source address, whichever bucket it was
+        self.throttled = collections.Counter()  # type: collections.Counter[str]
+        self.throttled_by_address = collections.Counter()  # type: collections.Counter
+
+    def _bucket(self, limit: Optional[Limit], now: float) -> Optional[TokenBucket]:
+        return TokenBucket(limit, now) if limit else None
+
+    def _buckets_for(self, session: Session, now: float):
+        session_buckets = self._session_buckets.get(session)
+        if session_buckets is None:
+            session_buckets = self._session_buckets[session] = (
+                self._bucket(self.session_lines, now), self._bucket(self.session_bytes, now)
+            )
+
+            address = source_address(session)
+            address_buckets = self._address_buckets.get(address)
+            if address_buckets is None:
+                address_buckets = self._address_buckets[address] = _AddressBuckets(
+                    self._bucket(self.address_lines, now), self._bucket(self.address_bytes, now)
+                )
+            address_buckets.session_count += 1
+
+        return session_buckets, self._address_buckets[source_address(session)]
+
+    def charge(self, session: Session, lines: int, nbytes: int) -> float:
+        """Charge what the session just read. Returns how many seconds it should wait before reading again"""
+        now = self.clock()
+        (session_lines, session_bytes), address_buckets = self._buckets_for(session, now)
+
+        wait = 0.0
+        for name, bucket, amount in (
+                ('session_lines', session_lines, lines),
+                ('session_bytes', session_bytes, nbytes),
+                ('address_lines', address_buckets.lines, lines),
+                ('address_bytes', address_buckets.bytes, nbytes),
+        ):
+            if bucket is None or not amount:
+                continue
+            bucket_wait = bucket.charge(amount, now)
+            if bucket_wait > 0:
+                self.throttled[name] += 1
+                wait = max(wait, bucket_wait)
+
+        if wait > 0:
+            self.throttled_by_address[source_address(session)] += 1
+        return wait
+
+    def forget(self, session: Session):
+        """The session is gone. Drop its buckets, and its address's when it was the last one"""
+        if self._session_buckets.pop(session, None) is None:
+            return
+
+        address = source_address(session)
+        address_buckets = self._address_buckets[address]
+        address_buckets.session_count -= 1
+        if address_buckets.session_count <= 0:
+            # a client reconnecting gets a full bucket. A fair trade for not keeping
+            # buckets around forever for every address that ever connected
+            del self._address_buckets[address]
+
+    def report(self) -> str:
+        lines = [f"Throttled sessions: {sum(self.throttled_by_address.values())} times"]
+        for name, count in self.throttled.most_common():
+            lines.append(f"  by {name}: {count}")
+        for address, count in self.throttled_by_address.most_common(10):
+            lines.append(f"  from {address}: {count}")
+        return "\n".join(lines)
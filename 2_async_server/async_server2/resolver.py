@@ -0,0 +1,130 @@
+"""
+Non-blocking DNS resolution for outbound connections.
+
+socket.connect((hostname, port)) runs getaddrinfo() right there, on the reactor thread,
+and every session freezes until the lookup is done. Here, getaddrinfo() runs on a small
+thread pool instead, and the results are handed back to the reactor thread
+(via Reactor.call_soon_threadsafe).
+
+On top of that:
+- results are cached. getaddrinfo() doesn't tell us the record's TTL, so the TTLs are fixed:
+  `positive_ttl` for answers, `negative_ttl` for failures
+- concurrent lookups of the same name are coalesced into a single getaddrinfo() call
+"""
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Any, NamedTuple, Union
+
+from .server import Reactor
+
+
+class Address(NamedTuple):
+    family: int
+    sockaddr: tuple
+
+
+class _CacheEntry(NamedTuple):
+    expires_at: float
+    result: Union[list[Address], OSError]
+
+
+def _literal_address(host: str, port: int):
+    """IP addresses don't need resolving"""
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+        except (OSError, TypeError):
+            continue
+        if family == socket.AF_INET6:
+            return [Address(family, (host, port, 0, 0))]
+        return [Address(family, (host, port))]
+    return None
+
+
+class Resolver:
+    _instance: "Resolver" = None
+
+    def __init__(self, positive_ttl: float = 60.0, negative_ttl: float = 5.0, max_cache_size: int = 1024,
+                 workers: int = 4, clock=time.monotonic):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_cache_size = max_cache_size
+        self.clock = clock
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='resolver')
+        self._cache = {}  # type: dict[tuple[str, int], _CacheEntry]
+        # lookups running right now -> whoever is waiting for them
+        self._in_flight = {}  # type: dict[tuple[str, int], list[tuple[Callable, Callable]]]
+
+        self.cache_hits = 0
+        self.lookups = 0
+
+    @classmethod
+    def get_instance(cls) -> "Resolver":
+        if not cls._instance:
+            cls._instance = cls()
+
+        return cls._instance
+
+    def resolve(self, host: str, port: int, on_result: Callable[[list[Address]], Any],
+                on_error: Callable[[OSError], Any]):
+        """Look up `host`. Call this on the reactor thread. The callbacks are called on it too
+
+        on_result gets the addresses in the order getaddrinfo() returned them. The callbacks
+        are never called before .resolve() returns, not even for cached answers, so the caller
+        can safely yield to the reactor after calling this.
+        """
+        reactor = Reactor.get_instance()
+        literal = _literal_address(host, port)
+        if literal:
+            reactor.call_soon(lambda: on_result(literal))
+            return
+
+        key = (host, port)
+        entry = self._cache.get(key)
+        if entry is not None:
+            if entry.expires_at > self.clock():
+                self.cache_hits += 1
+                reactor.call_soon(lambda: self._deliver(entry.result, on_result, on_error))
+                return
+            del self._cache[key]
+
+        waiters = self._in_flight.get(key)
+        if waiters is not None:
+            waiters.append((on_result, on_error))
+            return
+
+        self._in_flight[key] = [(on_result, on_error)]
+        self.lookups += 1
+        future = self._executor.submit(socket.getaddrinfo, host, port, type=socket.SOCK_STREAM)
+        future.add_done_callback(
+            lambda done: reactor.call_soon_threadsafe(lambda: self._lookup_done(key, done))
+        )
+
+    def _lookup_done(self, key, future):
+        try:
+            result = [Address(family, sockaddr) for family, _, _, _, sockaddr in future.result()]
+            ttl = self.positive_ttl
+        except OSError as err:
+            result = err
+            ttl = self.negative_ttl
+        except UnicodeError as err:
+            # names that can't even be IDNA-encoded
+            result = socket.gaierror(str(err))
+            ttl = self.negative_ttl
+
+        if len(self._cache) >= self.max_cache_size:
+            # dicts keep insertion order, so this drops the oldest entry
+            del self._cache[next(iter(self._cache))]
+        self._cache[key] = _CacheEntry(self.clock() + ttl, result)
+
+        for on_result, on_error in self._in_flight.pop(key):
+            self._deliver(result, on_result, on_error)
+
+    @staticmethod
+    def _deliver(result, on_result, on_error):
+        if isinstance(result, OSError):
+            on_error(result)
+        else:
+            on_result(result)
@@ -1,13 +1,23 @@
+import collections
 import enum
+import itertools
+import os
 import select
+import stat
 import socket
 import time
-import traceback
-from heapq import heappop
-from typing import NamedTuple, TextIO, Callable, Any, TypeVar, Coroutine, Optional
+from heapq import heappop, heappush
+from typing import NamedTuple, TextIO, Callable, Any, TypeVar, Coroutine, Optional, Union
+
+from .log import Logger
 
 T = TypeVar('T')
 
+logger = Logger.get_instance()
+
+# what cpu_report() calls the CPU time of timers and call_soon() tasks
+TASKS_HANDLER = '<scheduled tasks>'
+
 
 class SessionFinished(Exception):
     pass
@@ -22,9 +32,29 @@ class IOIntention(enum.Enum):
     """
     read = 'read'
     write = 'write'
+    # both at once. For sessions that move data both ways on the same socket (e.g. proxy.py)
+    read_write = 'read_write'
     none = 'none'
 
 
+class Layer:
+    """Transforms everything a Session sends and receives (see Session.layers), e.g. websocket framing
+
+    This one leaves the bytes alone
+    """
+
+    def encode(self, data: bytes) -> bytes:
+        """Bytes the handler wrote, on their way to the socket"""
+        return data
+
+    def decode(self, data: bytes) -> bytes:
+        """Bytes as received from the socket. b'' if nothing complete came through yet
+
+        Raise a ConnectionError to hang up, e.g. on garbage that can't be decoded
+        """
+        return data
+
+
 class Session:
     # optional because client sockets don't have this right away
     # but we're using the same ._connect method which requires an address
@@ -51,6 +81,21 @@ class Session:
 
     io_intention: IOIntention
 
+    # CPU seconds spent in this session's callbacks (accounted for by the Reactor),
+    # and how many times the Reactor called into this session
+    cpu_time: float
+    callback_count: int
+
+    # Bytes received but not consumed yet (see io.readline). When it holds a complete line,
+    # `input_pending` is set, and the Reactor runs the session without waiting for select(),
+    # which only knows about data still in the kernel
+    read_buffer: bytearray
+    input_pending: bool
+
+    # Between the handler and the socket. layers[0] is the closest to the socket, so it
+    # encodes last and decodes first. The handler only ever sees decoded bytes
+    layers: list[Layer]
+
     def __init__(self, address, file, socket_, next_callback, initial_callback, io_intention):
         self.address = address
         self.file = file
@@ -58,6 +103,11 @@ class Session:
         self._next_callback = next_callback
         self.initial_callback = initial_callback
         self.io_intention = io_intention
+        self.cpu_time = 0.0
+        self.callback_count = 0
+        self.read_buffer = bytearray()
+        self.input_pending = False
+        self.layers = []
 
         self._generator = initial_callback(self)
         x = 0
@@ -72,21 +122,46 @@ class Session:
             raise SessionFinished from err
 
         except Exception as err:
-            print(f"An unexpected exception has occurred: {type(err)}: {err}")
-            traceback.print_exc()
+            logger.exception('session_error', "An unexpected exception has occurred: %s: %s", type(err), err,
+                             address=self.address)
             raise SessionFinished from err
 
     def call_next_callback(self):
         # 1. ensure the session is started
         # 2. call self.next_callback(self)
         if self._next_callback is None:
-            self._next_callback = self._generator.send(None)
+            try:
+                self._next_callback = self._generator.send(None)
+            except StopIteration as err:
+                # finished without ever waiting for anything
+                raise SessionFinished from err
 
         self._next_callback(self)
 
     # TODO - this looks like we're creating a socket server framework
     def write(self, raw_bytes):
-        self.socket.sendall(raw_bytes)
+        for layer in reversed(self.layers):
+            raw_bytes = layer.encode(raw_bytes)
+        if raw_bytes:
+            self.socket.sendall(raw_bytes)
+
+    def add_layer(self, layer: Layer, index: Optional[int] = None):
+        """Put `layer` between the handler and the socket, at layers[index] (default: innermost)
+
+        Whatever was received already, but not read yet, goes through it too (see .decode_buffered)
+        """
+        self.layers.insert(len(self.layers) if index is None else index, layer)
+        self.decode_buffered(layer)
+
+    def decode_buffered(self, layer: Layer):
+        """Run what's in read_buffer through `layer`: it was decoded before `layer` was there (or on)
+
+        May raise a ConnectionError, like Layer.decode
+        """
+        leftover = bytes(self.read_buffer)
+        self.read_buffer.clear()
+        self.read_buffer += layer.decode(leftover)
+        self.input_pending = b'\n' in self.read_buffer
 
     def close(self):
         self._generator.close()
@@ -94,14 +169,28 @@ class Session:
         self.socket.close()
 
     def intends_read(self):
-        return self.io_intention == IOIntention.read
+        return self.io_intention == IOIntention.read or self.io_intention == IOIntention.read_write
 
     def intends_write(self):
-        return self.io_intention == IOIntention.write
+        return self.io_intention == IOIntention.write or self.io_intention == IOIntention.read_write
+
+    def awaits_buffered_input(self) -> bool:
+        """Whether the session waits in something that takes read_buffer first (readline, recv_some)
+
+        Those mark the function they yield with `reads_buffer`
+        """
+        return getattr(self._next_callback, 'reads_buffer', False)
+
+    @property
+    def handler_name(self) -> str:
+        """Name of the coroutine function driving this session, e.g. `command_server`"""
+        return getattr(self.initial_callback, '__qualname__', repr(self.initial_callback))
 
 
 class ScheduledEvent(NamedTuple):
     event_time: float
+    # breaks ties between events scheduled for the same time (tasks can't be compared)
+    sequence: int
     task: Any  # todo - add typing
 
 
@@ -111,8 +200,18 @@ def try_closing_the_server_socket(server_socket: socket.socket):
             try:
                 server_socket.shutdown(socket.SHUT_RD)
             except OSError:
-                print(f"vlad: failed to shut down the server in mode {mode}")
+                logger.debug('server_shutdown_failed', "vlad: failed to shut down the server in mode %s", mode)
+
+        # unix sockets leave a file behind (unless they're in the abstract namespace)
+        unix_path = None
+        if server_socket.family == socket.AF_UNIX:
+            unix_path = server_socket.getsockname()
         server_socket.close()
+        if isinstance(unix_path, str) and unix_path:
+            try:
+                os.unlink(unix_path)
+            except FileNotFoundError:
+                pass
 
 
 class Reactor:
@@ -126,9 +225,33 @@ class Reactor:
         self.server_callbacks = {}  # type: dict[socket.socket, Callable]
 
         self.events = []  # type: list[ScheduledEvent]
+        self._event_sequence = itertools.count()
+        # what the scheduled events' times are measured with. Swappable for a fake clock
+        self.clock = time.monotonic  # type: Callable[[], float]
+
+        # Tasks to run on the next tick (see .call_soon). Other threads (e.g. the DNS resolver)
+        # hand results back through here too, and write a byte to the socketpair to wake the
+        # reactor up from select()
+        self._soon_tasks = collections.deque()  # type: collections.deque[Callable[[], Any]]
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+
+        # Optional ratelimit.RateLimiter, to stop a single client from hogging the loop
+        self.rate_limiter = None
+        # The most a session reads from its socket in one go (so, per tick)
+        self.read_budget = 64 * 1024
 
         self._current_session = None
 
+        # CPU time accounting, aggregated per handler (per session it's kept on the Session).
+        # It's 2 thread_time() calls per callback, cheap enough to always have it on
+        self.handler_cpu_time = collections.Counter()  # type: collections.Counter[str]
+        self.handler_calls = collections.Counter()  # type: collections.Counter[str]
+        # one entry per _run_callback in progress: CPU time of the callbacks running inside it
+        # (a session resuming another), which is theirs and not its own
+        self._nested_cpu_time = []  # type: list[float]
+
     def start_reactor(self):
         try:
             if not self.server_callbacks:
@@ -145,71 +268,112 @@ class Reactor:
                 self.sessions[srv_socket] = None
 
             while True:
-                # ready_to_read, ready_to_write, _ = select.select(self.sessions, self.sessions, [], 0.1)
-                read_candidates = [
-                    socket_ for socket_, session in self.sessions.items() if
-                    session is None or session.intends_read()
-                ]
-                write_candidates = [
-                    socket_ for socket_, session in self.sessions.items() if
-                    session and session.intends_write()
-                ]
-                ready_to_read, ready_to_write, _ = select.select(
-                    read_candidates,
-                    write_candidates,
-                    [],
-                    0.1
-                )
-                # if ready_to_read:
-                #     print(f"start_reactor: {len(ready_to_read)} ready to read: \n{ready_to_read}\n\n")
-                # if ready_to_write:
-                #     print(f"start_reactor: {len(ready_to_write)} ready to write: \n{ready_to_write}\n\n")
-
-                for r_ready_socket in ready_to_read:
-                    if r_ready_socket in self.server_callbacks:
-                        assert isinstance(r_ready_socket, socket.socket)
-                        original_socket = r_ready_socket
-                        r_ready_socket, address = r_ready_socket.accept()
-                        self._connect(
-                            r_ready_socket, address, self.server_callbacks[original_socket],
-                            IOIntention.read,
-                        )
-                        continue
-
-                    # TODO - this looks weird, right?
-                    #  ...do we JUST call the next callback?
-                    #  ...don't we add anything to any queue?
-                    #  Well the next callback's job is to call reactor.make_progress
-                    #  which sets the next_callback
-                    session = self.sessions[r_ready_socket]
-                    self._current_session = session
-                    session.call_next_callback()
-
-                # TODO - what if the same socket is ready for both read and write?
-                #  Would be a weird situation! Server sockets, in my mental model
-                #  should listen, and client sockets should send. Well, client sockets
-                #  should receive stuff as well.
-                #  ...and what about client-created sockets? Those do both things
-                # wait a minute! so server sockets can indeed be read-only BUT
-                # client sockets are read-write.
-                # At this point I realised I don't know if this distinction
-                # between read/write matters OR if it matters a lot and I'm a n00b.
-                # Also... do we really need to wait until we can write? Is that a thing?
-                for w_ready_socket in ready_to_write:
-                    session = self.sessions[w_ready_socket]
-                    self._current_session = session
-                    session.call_next_callback()
-
-                self._current_session = None
-
-                # run scheduled events at the scheduled time
-                while self.events and self.events[0].event_time <= time.monotonic():
-                    event = heappop(self.events)
-                    event.task()
+                self.run_once()
         finally:
             for srv_socket in self.server_callbacks:
                 try_closing_the_server_socket(srv_socket)
 
+    def run_once(self, max_timeout: float = 0.1):
+        """One tick of the reactor: wait (at most `max_timeout`) for sockets to be ready,
+        run their callbacks, then whatever is due to run"""
+        # ready_to_read, ready_to_write, _ = select.select(self.sessions, self.sessions, [], 0.1)
+        read_candidates = [
+            socket_ for socket_, session in self.sessions.items() if
+            session is None or session.intends_read()
+        ]
+        read_candidates.append(self._wakeup_reader)
+        write_candidates = [
+            socket_ for socket_, session in self.sessions.items() if
+            session and session.intends_write()
+        ]
+        # sessions that already have a line buffered can go right away. If they're reading lines,
+        # that is: something else (e.g. an http response on its way) has to wait for the socket
+        already_readable = [
+            socket_ for socket_, session in self.sessions.items() if
+            session and session.input_pending and session.intends_read() and session.awaits_buffered_input()
+        ]
+        timeout = max_timeout
+        if already_readable or self._soon_tasks:
+            timeout = 0
+        elif self.events:
+            timeout = min(timeout, max(0.0, self.events[0].event_time - self.clock()))
+        ready_to_read, ready_to_write, _ = select.select(
+            read_candidates,
+            write_candidates,
+            [],
+            timeout
+        )
+        if already_readable:
+            ready_to_read = list(dict.fromkeys(ready_to_read + already_readable))
+        # if ready_to_read:
+        #     print(f"start_reactor: {len(ready_to_read)} ready to read: \n{ready_to_read}\n\n")
+        # if ready_to_write:
+        #     print(f"start_reactor: {len(ready_to_write)} ready to write: \n{ready_to_write}\n\n")
+
+        for r_ready_socket in ready_to_read:
+            if r_ready_socket is self._wakeup_reader:
+                self._drain_wakeups()
+                continue
+
+            if r_ready_socket in self.server_callbacks:
+                assert isinstance(r_ready_socket, socket.socket)
+                original_socket = r_ready_socket
+                r_ready_socket, address = r_ready_socket.accept()
+                if not address:
+                    # unix socket clients are usually unnamed. Use the server's path
+                    # so the session can still be told apart in logs and stats
+                    address = f"unix:{original_socket.getsockname()!r}"
+                self._connect(
+                    r_ready_socket, address, self.server_callbacks[original_socket],
+                    IOIntention.read,
+                )
+                continue
+
+            # TODO - this looks weird, right?
+            #  ...do we JUST call the next callback?
+            #  ...don't we add anything to any queue?
+            #  Well the next callback's job is to call reactor.make_progress
+            #  which sets the next_callback
+            session = self.sessions.get(r_ready_socket)
+            if session is None:
+                # closed by another session's callback, earlier in this tick
+                continue
+            self._run_callback(session, session.call_next_callback)
+
+        # TODO - what if the same socket is ready for both read and write?
+        #  Would be a weird situation! Server sockets, in my mental model
+        #  should listen, and client sockets should send. Well, client sockets
+        #  should receive stuff as well.
+        #  ...and what about client-created sockets? Those do both things
+        # wait a minute! so server sockets can indeed be read-only BUT
+        # client sockets are read-write.
+        # At this point I realised I don't know if this distinction
+        # between read/write matters OR if it matters a lot and I'm a n00b.
+        # Also... do we really need to wait until we can write? Is that a thing?
+        for w_ready_socket in ready_to_write:
+            session = self.sessions.get(w_ready_socket)
+            if session is None:
+                continue
+            self._run_callback(session, session.call_next_callback)
+
+        self._current_session = None
+
+        while self._soon_tasks:
+            self._run_task(self._soon_tasks.popleft())
+
+        # run scheduled events at the scheduled time
+        while self.events and self.events[0].event_time <= self.clock():
+            event = heappop(self.events)
+            self._run_task(event.task)
+
+    def _run_task(self, task: Callable[[], Any]):
+        # one broken task (or timer) shouldn't take every session down with it
+        try:
+            # not any session's time, unless it resumes one: that part gets charged to it
+            self._run_callback(None, task)
+        except Exception as err:
+            logger.exception('task_error', "A scheduled task failed: %s: %s", type(err), err, task=task)
+
     def _connect(self, s: socket.socket, address, async_callback, io_intention):
         sess = Session(
             address, s.makefile(), s, None, initial_callback=async_callback,
@@ -226,18 +390,60 @@ class Reactor:
         # why (None) ? I guess that's a detail of how stuff works.
         # because: "TypeError: can't send non-None value to a just-started coroutine"
         # sess.next_callback = sess.generator.send(None)
-        self._current_session = sess
-        sess._make_progress(None)  # noqa
+        self._run_callback(sess, sess._make_progress, None)  # noqa
+
+    def _run_callback(self, session: Optional[Session], callback, *args):
+        """Call into a session, and charge the CPU time it took to that session and its handler
+
+        No session means a scheduled task, which goes under TASKS_HANDLER.
+        Callbacks can nest: when one resumes another session (see .make_progress), the time
+        that took is charged to the resumed session, and not to the one that resumed it.
+
+        The profiler also looks for this frame, to label the stacks below it with
+        the session's address.
+        """
+        previous_session, self._current_session = self._current_session, session
+        self._nested_cpu_time.append(0.0)
+        started = time.thread_time()
+        try:
+            callback(*args)
+        except SessionFinished:
+            self.close_session(session)
+        finally:
+            elapsed = time.thread_time() - started
+            own_time = elapsed - self._nested_cpu_time.pop()
+            if self._nested_cpu_time:
+                self._nested_cpu_time[-1] += elapsed
+            self._current_session = previous_session
+
+            if session is None:
+                handler_name = TASKS_HANDLER
+            else:
+                session.cpu_time += own_time
+                session.callback_count += 1
+                handler_name = session.handler_name
+            self.handler_cpu_time[handler_name] += own_time
+            self.handler_calls[handler_name] += 1
+
+    def _drain_wakeups(self):
+        try:
+            while self._wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
 
     def _disconnect(self, s: socket.socket):
         # TODO - when do we close server sockets? :/
         #  ...after a certain amount of time of them not being used
         #  is a reasonable approach
-        self.sessions[s].close()
+        session = self.sessions[s]
+        session.close()
         # self.sessions[s].generator.close()
         # self.sessions[s].file.close()
         # s.close()
         del self.sessions[s]
+        if self.rate_limiter:
+            self.rate_limiter.forget(session)
 
     @classmethod
     def get_instance(cls) -> "Reactor":
@@ -246,29 +452,44 @@ class Reactor:
 
         return cls._instance
 
-    def add_server_socket_and_callback(self, s: socket.socket, callback):
+    def add_server_socket_and_callback(self, s: Union[socket.socket, str, tuple], callback):
         """
         :param s: This is a server socket, meaning we'll not use this to send/recv, but
             we'll only use it to accept(). accept() creates a client socket, that we can use
             for actually sending/receiving data. It's important to distinguish server from
             client sockets (though both of these are on the server...not sure how to call them)
+            Instead of a socket, this can also be an address, and the socket gets created here:
+            a unix socket path ("@name" for the abstract namespace) or a (host, port) tuple.
         :param callback: whatever function the client of the Reactor wants to execute.
             Notice that this entire thing assumes a synchronous programming style, I think!
         """
+        if isinstance(s, str):
+            s = create_async_server_socket(s)
+        elif isinstance(s, tuple):
+            s = create_async_server_socket(*s)
         self.server_callbacks[s] = callback
+        return s
 
     def make_progress(self, session: Session, result, next_intention: IOIntention):
         """This appears to need to be a public method"""
+        if session is not self._current_session:
+            # resuming some other session, e.g. when its http request is done: that's its CPU time
+            self._run_callback(session, self._resume, session, result)
+        else:
+            self._resume(session, result)
+
+    def _resume(self, session: Session, result):
         try:
             # accessing protected member! Yes!
             # This protected member is made to be called exactly
             # from here!
             session._make_progress(result)  # noqa
         except SessionFinished:
-            self._disconnect(session.socket)
+            # not necessarily still there: e.g. a session that quit while its HTTP request was in flight
+            self.close_session(session)
 
-    def add_client_socket_and_callback(self, client_sock: socket.socket, async_callback):
-        self.sessions[client_sock] = Session(
+    def add_client_socket_and_callback(self, client_sock: socket.socket, async_callback) -> Session:
+        session = self.sessions[client_sock] = Session(
             address=None,
             file=client_sock.makefile(),
             socket_=client_sock,
@@ -276,33 +497,149 @@ class Reactor:
             initial_callback=async_callback,
             io_intention=IOIntention.write,
         )
+        return session
 
     def get_current_session(self):
         return self._current_session
 
+    def close_session(self, session: Session):
+        """Close a session from the outside (e.g. from another session's callback)"""
+        if self.sessions.get(session.socket) is session:
+            self._disconnect(session.socket)
+
+    def call_soon(self, task: Callable[[], Any]):
+        """Run `task()` on the next tick, after the current callback is done"""
+        self._soon_tasks.append(task)
 
-def create_async_server_socket(host, port, reuse: bool = False):
+    def call_soon_threadsafe(self, task: Callable[[], Any]):
+        """Same as .call_soon, but safe to call from any thread"""
+        self._soon_tasks.append(task)
+        try:
+            self._wakeup_writer.send(b'\0')
+        except BlockingIOError:
+            # the socketpair is full of wakeups already, the reactor will notice anyway
+            pass
+
+    def call_later(self, delay: float, task: Callable[[], Any]) -> ScheduledEvent:
+        """Run `task()` on the reactor thread, after `delay` seconds"""
+        event = ScheduledEvent(self.clock() + delay, next(self._event_sequence), task)
+        heappush(self.events, event)
+        return event
+
+    def charge_read(self, session: Session, lines: int, nbytes: int):
+        """Tell the rate limiter (if any) what `session` just read. Throttles the session if needed
+
+        A throttled session simply isn't selected for reading until its tokens refill,
+        so it costs nothing while it waits.
+        """
+        if self.rate_limiter is None or self.sessions.get(session.socket) is not session:
+            return
+
+        wait = self.rate_limiter.charge(session, lines, nbytes)
+        if wait <= 0 or not session.intends_read():
+            return
+
+        session.io_intention = IOIntention.none
+
+        def resume_reading():
+            # the session might have quit, or moved on to something else, in the meantime
+            if self.sessions.get(session.socket) is session and session.io_intention == IOIntention.none:
+                session.io_intention = IOIntention.read
+
+        self.call_later(wait, resume_reading)
+
+    def cpu_report(self) -> str:
+        """Human readable CPU usage, per handler and per live session. Most expensive first"""
+        lines = ["CPU time per handler:"]
+        for name, cpu_time in self.handler_cpu_time.most_common():
+            lines.append(f"  {name}: {cpu_time * 1000:.3f}ms in {self.handler_calls[name]} callbacks")
+
+        lines.append("CPU time per session:")
+        live_sessions = sorted(
+            (session for session in self.sessions.values() if session),
+            key=lambda session: session.cpu_time,
+            reverse=True,
+        )
+        for session in live_sessions:
+            lines.append(
+                f"  {session.address} ({session.handler_name}): "
+                f"{session.cpu_time * 1000:.3f}ms in {session.callback_count} callbacks"
+            )
+        return "\n".join(lines)
+
+
+def _unix_path(path: str) -> str:
+    """"@name" means "name" in the abstract namespace (linux only), which leaves no file behind"""
+    if path.startswith('@'):
+        return '\0' + path[1:]
+    return path
+
+
+def _is_ipv6_literal(host) -> bool:
+    try:
+        socket.inet_pton(socket.AF_INET6, host)
+    except (OSError, TypeError):
+        return False
+    return True
+
+
+def _remove_stale_unix_socket(path: str):
+    """A previous run that wasn't shut down cleanly leaves the socket file, and bind() fails"""
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def create_async_server_socket(host, port=None, reuse: bool = False, dual_stack: bool = False):
     """
-    :param host:
+    :param host: A hostname or an IPv4/IPv6 address. If `port` is None, this is the path of a
+        unix socket instead ("@name" for the abstract namespace). Unix sockets skip the whole
+        TCP stack, so they're the faster choice when both ends are on the same machine.
     :param port:
     :param reuse: If true, allows shutting down the server and starting it up
         right away. Otherwise, we have to wait 1min before starting it up again
         https://stackoverflow.com/questions/4465959/python-errno-98-address-already-in-use
         In production, you'd want this set to `false`.
+        For unix sockets, this removes a socket file left over by a previous run.
+    :param dual_stack: If true, listen on IPv6 and accept IPv4 clients on the same socket
+        (they show up as ::ffff:a.b.c.d). Use host "::" or "" to listen on all interfaces.
     :return:
     """
     # socket.socket, bind, accept, listen, send, (recv to do), close, shutdown
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    if reuse:
-        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_socket.bind((host, port))
+    if port is None:
+        path = _unix_path(host)
+        server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if reuse and not path.startswith('\0'):
+            _remove_stale_unix_socket(path)
+        server_socket.bind(path)
+    else:
+        if dual_stack or _is_ipv6_literal(host):
+            server_socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+            server_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0 if dual_stack else 1)
+        else:
+            server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if reuse:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((host, port))
     server_socket.listen()
     server_socket.setblocking(False)
     return server_socket
 
 
 def create_async_client_socket(address):
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    """
+    :param address: (host, port) for TCP over IPv4/IPv6, or a unix socket path
+        ("@name" for the abstract namespace)
+    """
+    if isinstance(address, str):
+        client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        address = _unix_path(address)
+    elif _is_ipv6_literal(address[0]):
+        client_socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    else:
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     client_socket.connect(address)
     client_socket.setblocking(False)
     return client_socket